@@ -1,7 +1,9 @@
 from __future__ import division
-from collections import Counter
-from linear_algebra import distance, vector_subtract, scalar_multiply
-import math, random
+from collections import Counter, deque
+from functools import partial
+from linear_algebra import distance, vector_add, vector_subtract, scalar_multiply, \
+    dot, magnitude
+import math, random, os, time, json, cPickle, multiprocessing
 
 
 def sum_of_squares(v):
@@ -34,9 +36,76 @@ def partial_difference_quotient(f, v, i, h):
     return (f(w) - f(v)) / h
 
 
-def estimate_gradient(f, v, h=0.00001):
-    return [partial_difference_quotient(f, v, i, h)
-            for i, _ in enumerate(v)]
+def perturbed_values(f, v, shifts, pool=None):
+    """for each shift, the list of f evaluated at v with shift added to
+    the i-th element, for every i"""
+    """without a pool, the perturbations are made in place in a single
+    copy of v (so f mustn't hold on to its argument); with a pool (anything
+    with a map method, like a multiprocessing.Pool) every point is built
+    and the evaluations are shared out, so f must be picklable"""
+    n = len(v)
+    if pool is not None:
+        points = [list(v[:i]) + [v[i] + shift] + list(v[i + 1:])
+                  for shift in shifts for i in range(n)]
+        values = pool.map(f, points)
+    else:
+        w = list(v)
+        values = []
+        for shift in shifts:
+            for i in range(n):
+                w[i] = v[i] + shift
+                values.append(f(w))
+                w[i] = v[i]
+    return [values[k * n:(k + 1) * n] for k in range(len(shifts))]
+
+
+def estimate_gradient(f, v, h=None, method="forward", pool=None):
+    """estimate the gradient of f at v by finite differences:
+    "forward" evaluates f(v) once and once per element (n + 1 in all),
+    with error proportional to h; "central" evaluates f twice per element,
+    with error proportional to h ** 2; "complex" takes the imaginary part
+    of f(v + ih) once per element, which has no subtraction to lose
+    precision in, so h can be tiny and the result is exact up to rounding,
+    but f has to accept complex input (cmath rather than math, no abs)"""
+    """h defaults to 0.00001, or 1e-20 for the complex step; pool is passed
+    on to perturbed_values"""
+    if h is None:
+        h = 1e-20 if method == "complex" else 0.00001
+    if method == "forward":
+        f_v = f(v)
+        forward, = perturbed_values(f, v, [h], pool)
+        return [(f_w - f_v) / h for f_w in forward]
+    elif method == "central":
+        forward, backward = perturbed_values(f, v, [h, -h], pool)
+        return [(f_plus - f_minus) / (2 * h)
+                for f_plus, f_minus in zip(forward, backward)]
+    elif method == "complex":
+        imaginary, = perturbed_values(f, v, [h * 1j], pool)
+        return [f_w.imag / h for f_w in imaginary]
+    raise ValueError("unknown method: %s" % method)
+
+
+def benchmark_estimate_gradient(n=200, repeats=5):
+    """seconds per gradient of sum_of_squares in n dimensions for the
+    original one-partial_difference_quotient-per-element estimate and each
+    method, with the largest error against the exact gradient"""
+    v = [random.random() for _ in range(n)]
+    exact = sum_of_squares_gradient(v)
+    estimators = {
+        "partial_difference_quotient": lambda: [
+            partial_difference_quotient(sum_of_squares, v, i, 0.00001)
+            for i in range(n)],
+        "forward": lambda: estimate_gradient(sum_of_squares, v),
+        "central": lambda: estimate_gradient(sum_of_squares, v, method="central"),
+        "complex": lambda: estimate_gradient(sum_of_squares, v, method="complex") }
+    results = {}
+    for name, estimator in estimators.iteritems():
+        start = time.time()
+        for _ in range(repeats):
+            estimate = estimator()
+        results[name] = ((time.time() - start) / repeats,
+                         max(abs(e - g) for e, g in zip(estimate, exact)))
+    return results
 
 
 def step(v, direction, step_size):
@@ -65,40 +134,260 @@ def safe(f):
 #
 #
 
-def minimize_batch(target_fn, gradient_fn, theta_0, tolerance=0.000001):
+def backtracking_line_search(target_fn, theta, value, gradient, step_size=1,
+                             shrink=0.5, sufficient_decrease=0.0001,
+                             min_step_size=1e-10):
+    """Armijo backtracking: starting from step_size, shrink the step until
+    moving against the gradient decreases target_fn by at least
+    sufficient_decrease * step_size * |gradient|^2"""
+    """returns the step size, the new theta and its value, so the caller
+    never has to evaluate target_fn at the new theta again"""
+    squared_norm = sum_of_squares(gradient)
+    while True:
+        next_theta = step(theta, gradient, -step_size)
+        next_value = target_fn(next_theta)
+        if (next_value <= value - sufficient_decrease * step_size * squared_norm
+                or step_size < min_step_size):
+            return step_size, next_theta, next_value
+        step_size *= shrink
+
+
+# the target function in each of minimize_batch's pool workers, set once
+# when the worker starts, so only the candidate thetas are sent per step
+_worker_target_fn = None
+
+
+def _set_worker_target_fn(target_fn):
+    global _worker_target_fn
+    _worker_target_fn = safe(target_fn)
+
+
+def _evaluate_candidate(theta):
+    return _worker_target_fn(theta)
+
+
+def minimize_batch(target_fn, gradient_fn, theta_0, tolerance=0.000001,
+                   optimizer=None, line_search="grid", processes=1):
     """use gradient descent to find theta that minimizes target function"""
+    """if optimizer is given, each step is the optimizer's update instead of
+    the best of a fixed list of step sizes"""
+    """line_search="backtracking" replaces the fixed list with an Armijo
+    backtracking search, which starts from twice the last accepted step and
+    usually needs only one or two evaluations of target_fn per step"""
+    """with processes > 1 the fixed list of step sizes is evaluated
+    concurrently; target_fn is handed to each worker once, when the pool
+    starts, and after that only the candidate thetas are sent (the other
+    modes evaluate one candidate at a time, so they can't use a pool)"""
+    if line_search not in ("grid", "backtracking"):
+        raise ValueError("unknown line_search: %s" % line_search)
+    if processes > 1 and (optimizer is not None or line_search != "grid"):
+        raise ValueError("processes > 1 only works with the grid line search, "
+                         "and no optimizer")
     step_sizes = [100, 10, 1, 0.1, 0.01, 0.001, 0.0001, 0.00001]
     theta = theta_0                           # set theta to initial value
-    target_fn = safe(target_fn)               # safe version of target_fn
-    value = target_fn(theta)                  # value we're minimizing
-    while True:
-        gradient = gradient_fn(theta)
-        next_thetas = [step(theta, gradient, -step_size) for step_size in step_sizes]
-        # choose the one that minimizes the error function
-        next_theta = min(next_thetas, key=target_fn)
-        next_value = target_fn(next_theta)
-        # stop if we're "converging"
-        if abs(value - next_value) < tolerance:
-            return theta
-        else:
-            theta, value = next_theta, next_value
+    safe_target_fn = safe(target_fn)          # safe version of target_fn
+    value = safe_target_fn(theta)             # value we're minimizing
+    accepted_step_size = 0.5                  # doubled before the first search
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, _set_worker_target_fn,
+                                    (target_fn,))
+    try:
+        while True:
+            gradient = gradient_fn(theta)
+            if optimizer is not None:
+                next_theta = list(theta)
+                optimizer.update(next_theta, gradient)
+                next_value = safe_target_fn(next_theta)
+            elif line_search == "backtracking":
+                accepted_step_size, next_theta, next_value = \
+                    backtracking_line_search(safe_target_fn, theta, value,
+                                             gradient, 2 * accepted_step_size)
+            else:
+                next_thetas = [step(theta, gradient, -step_size)
+                               for step_size in step_sizes]
+                if pool is not None:
+                    values = pool.map(_evaluate_candidate, next_thetas)
+                else:
+                    values = map(safe_target_fn, next_thetas)
+                # choose the one that minimizes the error function,
+                # and keep its value rather than computing it again
+                best = min(range(len(next_thetas)), key=values.__getitem__)
+                next_theta, next_value = next_thetas[best], values[best]
+            # stop if we're "converging"
+            if abs(value - next_value) < tolerance:
+                return theta
+            else:
+                theta, value = next_theta, next_value
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def _negated(f, *args, **kwargs):
+    return -f(*args, **kwargs)
+
+
+def _negated_all(f, *args, **kwargs):
+    return [-y for y in f(*args, **kwargs)]
 
 
 def negate(f):
     """return a function that for any input x returns -f(x)"""
-    return lambda *args, **kwargs: -f(*args, **kwargs)
+    """(a partial rather than a lambda, so it can be sent to worker processes)"""
+    return partial(_negated, f)
 
 
 def negate_all(f):
     """the same when f returns a list of numbers"""
-    return lambda *args, **kwargs: [-y for y in f(*args, **kwargs)]
+    return partial(_negated_all, f)
 
 
-def maximize_batch(target_fn, gradient_fn, theta_0, tolerance=0.000001):
+def maximize_batch(target_fn, gradient_fn, theta_0, tolerance=0.000001,
+                   optimizer=None, line_search="grid", processes=1):
     return minimize_batch(negate(target_fn),
                           negate_all(gradient_fn),
                           theta_0,
-                          tolerance)
+                          tolerance,
+                          optimizer,
+                          line_search,
+                          processes)
+
+#
+#
+# minimize / maximize lbfgs
+#
+#
+
+def wolfe_line_search(target_fn, gradient_fn, theta, value, gradient,
+                      direction, step_size=1, c1=0.0001, c2=0.9,
+                      max_iterations=20):
+    """find a step size along direction that satisfies the strong Wolfe
+    conditions: target_fn decreases by at least c1 * step_size * slope
+    (where slope is the initial directional derivative), and the new
+    slope is at most c2 times as steep as the initial one"""
+    """returns (step_size, theta, value, gradient) at the point found;
+    a step size of 0 means no acceptable step was found"""
+    slope_0 = dot(gradient, direction)
+
+    def at(step_size):
+        next_theta = step(theta, direction, step_size)
+        return [step_size, next_theta, target_fn(next_theta), None, None]
+
+    def with_gradient(point):
+        point[3] = gradient_fn(point[1])
+        point[4] = dot(point[3], direction)
+        return point
+
+    def sufficient_decrease(point):
+        return point[2] <= value + c1 * point[0] * slope_0
+
+    def curvature(point):
+        return abs(point[4]) <= -c2 * slope_0
+
+    def zoom(low, high):
+        """shrink the bracket [low, high], which contains an acceptable
+        step, until we find one; low is the end with the smaller value"""
+        for _ in range(max_iterations):
+            width = high[0] - low[0]
+            # minimum of the quadratic through low's value and slope and
+            # high's value, unless it's too close to either end
+            denominator = 2 * (high[2] - low[2] - low[4] * width)
+            if denominator > 0 and not math.isinf(high[2]):
+                trial = low[0] - low[4] * width * width / denominator
+            else:
+                trial = None
+            if trial is None or not (0.1 <= (trial - low[0]) / width <= 0.9):
+                trial = low[0] + width / 2
+            point = at(trial)
+            if not sufficient_decrease(point) or point[2] >= low[2]:
+                high = point
+            else:
+                with_gradient(point)
+                if curvature(point):
+                    return point
+                if point[4] * width >= 0:
+                    high = low
+                low = point
+        return low
+
+    previous = [0, theta, value, gradient, slope_0]
+    for i in range(max_iterations):
+        point = at(step_size)
+        if not sufficient_decrease(point) or (i > 0 and point[2] >= previous[2]):
+            return tuple(zoom(previous, point)[:4])
+        with_gradient(point)
+        if curvature(point):
+            return tuple(point[:4])
+        if point[4] >= 0:
+            return tuple(zoom(point, previous)[:4])
+        previous = point
+        step_size *= 2
+    return tuple(previous[:4])
+
+
+def lbfgs_direction(gradient, history):
+    """the quasi-Newton direction -H * gradient, where H approximates the
+    inverse Hessian from the (s, y, rho) pairs in history (oldest first),
+    by the L-BFGS two-loop recursion"""
+    q = list(gradient)
+    alphas = []
+    for s, y, rho in reversed(history):
+        a = rho * dot(s, q)
+        alphas.append(a)
+        q = vector_subtract(q, scalar_multiply(a, y))
+    if history:
+        s, y, _ = history[-1]
+        q = scalar_multiply(dot(s, y) / dot(y, y), q)   # initial scaling
+    for (s, y, rho), a in zip(history, reversed(alphas)):
+        b = rho * dot(y, q)
+        q = vector_add(q, scalar_multiply(a - b, s))
+    return scalar_multiply(-1, q)
+
+
+def minimize_lbfgs(target_fn, gradient_fn, theta_0, tolerance=0.000001,
+                   history_size=10):
+    """use limited-memory BFGS to find theta that minimizes target function;
+    the curvature of the last history_size steps turns the gradient into a
+    quasi-Newton direction, and a strong Wolfe line search picks the step"""
+    theta = list(theta_0)
+    target_fn = safe(target_fn)
+    value = target_fn(theta)
+    gradient = gradient_fn(theta)
+    history = deque(maxlen=history_size)
+    while True:
+        if magnitude(gradient) == 0:
+            return theta
+        direction = lbfgs_direction(gradient, history)
+        if dot(direction, gradient) >= 0:
+            # not a descent direction, so start over from the gradient
+            history.clear()
+            direction = scalar_multiply(-1, gradient)
+        # with no history the direction isn't scaled, so be careful
+        initial_step = 1 if history else min(1, 1 / magnitude(gradient))
+        step_size, next_theta, next_value, next_gradient = wolfe_line_search(
+            target_fn, gradient_fn, theta, value, gradient, direction,
+            initial_step)
+        if step_size == 0:
+            return theta                # the line search made no progress
+        s = vector_subtract(next_theta, theta)
+        y = vector_subtract(next_gradient, gradient)
+        if dot(s, y) > 1e-10:          # only keep pairs with positive curvature
+            history.append((s, y, 1 / dot(s, y)))
+        # stop if we're "converging"
+        if abs(value - next_value) < tolerance:
+            return next_theta
+        theta, value, gradient = next_theta, next_value, next_gradient
+
+
+def maximize_lbfgs(target_fn, gradient_fn, theta_0, tolerance=0.000001,
+                   history_size=10):
+    return minimize_lbfgs(negate(target_fn),
+                          negate_all(gradient_fn),
+                          theta_0,
+                          tolerance,
+                          history_size)
 
 #
 # minimize / maximize stochastic
@@ -112,7 +401,8 @@ def in_random_order(data):
         yield data[i]
 
 
-def minimize_stochastic(target_fn, gradient_fn, x, y, theta_0, alpha_0=0.01):
+def minimize_stochastic(target_fn, gradient_fn, x, y, theta_0, alpha_0=0.01,
+                        optimizer=None):
     data = zip(x, y)
     theta = theta_0                             # initial guess
     alpha = alpha_0                             # initial step size
@@ -134,14 +424,593 @@ def minimize_stochastic(target_fn, gradient_fn, x, y, theta_0, alpha_0=0.01):
         # and take a gradient step for each of the data points
         for x_i, y_i in in_random_order(data):
             gradient_i = gradient_fn(x_i, y_i, theta)
-            theta = vector_subtract(theta, scalar_multiply(alpha, gradient_i))
+            if optimizer is None:
+                theta = vector_subtract(theta, scalar_multiply(alpha, gradient_i))
+            else:
+                theta = list(theta)     # min_theta may still be the old one
+                optimizer.update(theta, gradient_i, alpha / alpha_0)
     return min_theta
 
 
-def maximize_stochastic(target_fn, gradient_fn, x, y, theta_0, alpha_0=0.01):
+def maximize_stochastic(target_fn, gradient_fn, x, y, theta_0, alpha_0=0.01,
+                        optimizer=None):
     return minimize_stochastic(negate(target_fn),
                                negate_all(gradient_fn),
-                               x, y, theta_0, alpha_0)
+                               x, y, theta_0, alpha_0, optimizer)
+#
+# minimize / maximize mini-batch
+#
+
+def minimize_mini_batch(target_fn, gradient_fn, data_source, theta_0,
+                        alpha_0=0.01, batch_size=32, batch_gradient_fn=None,
+                        evaluation_size=1000, shuffle_buffer_size=10000,
+                        rng=random, optimizer=None):
+    """like minimize_stochastic, but steps along the average gradient of
+    batch_size points at a time, and judges improvement on a fixed random
+    sample of evaluation_size points instead of the whole dataset"""
+    """the sample is reservoir-sampled from the first epoch's stream, so it
+    is a subsample of the training data, not a holdout: like
+    minimize_stochastic, this stops when the training loss stops improving,
+    and says nothing about overfitting (TrainingRun's validation_fn does)"""
+    """data_source is a list of (x_i, y_i) pairs, or a function returning a
+    fresh iterator over them for each epoch (say, reading them from a file),
+    so the data never has to be in memory at once; it is shuffled within a
+    buffer of shuffle_buffer_size points as it streams past"""
+    """batch_gradient_fn(x_batch, y_batch, theta), if given, returns the
+    summed gradient of a whole batch; otherwise gradient_fn is summed"""
+    if not callable(data_source):
+        data = data_source
+        data_source = lambda: iter(data)
+    if batch_gradient_fn is None:
+        batch_gradient_fn = partial(sum_of_gradients, gradient_fn)
+
+    theta = list(theta_0)                       # updated in place
+    alpha = alpha_0
+    min_theta, min_value = None, float("inf")
+    iterations_with_no_improvement = 0
+    evaluation_sample = None
+
+    while iterations_with_no_improvement < 100:
+        # the evaluation sample is reservoir-sampled from the first epoch
+        # (and trained on too, like every other point)
+        reservoir = [] if evaluation_sample is None else None
+        points = shuffled(data_source(), shuffle_buffer_size, rng)
+        for x_batch, y_batch in batches(points, batch_size, reservoir,
+                                        evaluation_size, rng):
+            gradient = batch_gradient_fn(x_batch, y_batch, theta)
+            if optimizer is None:
+                step_size = alpha / len(x_batch)
+                for j, gradient_j in enumerate(gradient):
+                    theta[j] -= step_size * gradient_j
+            else:
+                mean_gradient = [gradient_j / len(x_batch) for gradient_j in gradient]
+                optimizer.update(theta, mean_gradient, alpha / alpha_0)
+        if reservoir is not None:
+            evaluation_sample = reservoir
+
+        value = sum(target_fn(x_i, y_i, theta) for x_i, y_i in evaluation_sample)
+        if value < min_value:
+            min_theta, min_value = list(theta), value
+            iterations_with_no_improvement = 0
+            alpha = alpha_0
+        else:
+            iterations_with_no_improvement += 1
+            alpha *= 0.9
+    return min_theta
+
+
+def maximize_mini_batch(target_fn, gradient_fn, data_source, theta_0,
+                        alpha_0=0.01, batch_size=32, batch_gradient_fn=None,
+                        **kwargs):
+    return minimize_mini_batch(negate(target_fn),
+                               negate_all(gradient_fn),
+                               data_source, theta_0, alpha_0, batch_size,
+                               batch_gradient_fn and negate_all(batch_gradient_fn),
+                               **kwargs)
+
+
+def sum_of_gradients(gradient_fn, x_batch, y_batch, theta):
+    """the summed gradient of a batch, accumulated in place"""
+    total = [0.0] * len(theta)
+    for x_i, y_i in zip(x_batch, y_batch):
+        for j, gradient_ij in enumerate(gradient_fn(x_i, y_i, theta)):
+            total[j] += gradient_ij
+    return total
+
+
+def shuffled(points, buffer_size, rng=random):
+    """generates points in a random order, holding at most buffer_size of
+    them at a time: each new point swaps out a random buffered one"""
+    buffer = []
+    for point in points:
+        if len(buffer) < buffer_size:
+            buffer.append(point)
+        else:
+            i = int(buffer_size * rng.random())
+            yield buffer[i]
+            buffer[i] = point
+    rng.shuffle(buffer)
+    for point in buffer:
+        yield point
+
+
+def batches(points, batch_size, reservoir=None, reservoir_size=0, rng=random):
+    """groups (x_i, y_i) points into (x_batch, y_batch) lists; if reservoir
+    is a list, it ends up a uniform sample of reservoir_size points"""
+    x_batch, y_batch = [], []
+    for n, (x_i, y_i) in enumerate(points):
+        if reservoir is not None:
+            if len(reservoir) < reservoir_size:
+                reservoir.append((x_i, y_i))
+            else:
+                i = int((n + 1) * rng.random())
+                if i < reservoir_size:
+                    reservoir[i] = (x_i, y_i)
+        x_batch.append(x_i)
+        y_batch.append(y_i)
+        if len(x_batch) == batch_size:
+            yield x_batch, y_batch
+            x_batch, y_batch = [], []
+    if x_batch:
+        yield x_batch, y_batch
+
+
+#
+# optimizers
+#
+
+# an optimizer turns a gradient into a step, keeping whatever state it needs
+# between steps; pass one as optimizer= to minimize_batch, minimize_stochastic
+# or minimize_mini_batch (or their maximize_ versions) or TrainingRun
+#
+# the step size is always the optimizer's learning_rate (times its schedule);
+# entry points that shrink their step size when they stop improving pass
+# that along as a multiplier, alpha / alpha_0, which is 1 until then, so
+# alpha_0 itself only matters when there's no optimizer
+
+class GradientStep:
+    """plain gradient descent: theta -= alpha * gradient"""
+
+    def __init__(self, learning_rate=0.01, schedule=None):
+        self.learning_rate = learning_rate  # alpha
+        self.schedule = schedule            # step number -> multiplier for alpha
+        self.t = 0                          # steps taken so far
+
+    def update(self, theta, gradient, multiplier=1):
+        """moves theta, in place, one step against gradient, of
+        learning_rate * multiplier (times the schedule's multiplier)"""
+        alpha = self.learning_rate * multiplier
+        self.t += 1
+        if self.schedule is not None:
+            alpha *= self.schedule(self.t)
+        self.apply(theta, gradient, alpha)
+
+    def apply(self, theta, gradient, alpha):
+        for j, gradient_j in enumerate(gradient):
+            theta[j] -= alpha * gradient_j
+
+
+class Momentum(GradientStep):
+    """steps along a running (decaying) sum of past gradients, which damps
+    zig-zagging across narrow valleys and speeds up along them"""
+
+    def __init__(self, learning_rate=0.01, momentum=0.9, schedule=None,
+                 nesterov=False):
+        GradientStep.__init__(self, learning_rate, schedule)
+        self.momentum = momentum
+        self.nesterov = nesterov
+        self.velocity = None
+
+    def apply(self, theta, gradient, alpha):
+        if self.velocity is None:
+            self.velocity = [0.0] * len(theta)
+        mu, velocity = self.momentum, self.velocity
+        for j, gradient_j in enumerate(gradient):
+            velocity[j] = mu * velocity[j] + gradient_j
+            if self.nesterov:
+                # look ahead to where the velocity is about to take us
+                theta[j] -= alpha * (gradient_j + mu * velocity[j])
+            else:
+                theta[j] -= alpha * velocity[j]
+
+
+class Nesterov(Momentum):
+    """momentum with Nesterov's look-ahead correction"""
+
+    def __init__(self, learning_rate=0.01, momentum=0.9, schedule=None):
+        Momentum.__init__(self, learning_rate, momentum, schedule, nesterov=True)
+
+
+class AdaGrad(GradientStep):
+    """scales each coordinate's step by 1 / sqrt(sum of its squared
+    gradients so far), so rarely-moving coordinates take bigger steps"""
+
+    def __init__(self, learning_rate=0.1, schedule=None, epsilon=1e-8):
+        GradientStep.__init__(self, learning_rate, schedule)
+        self.epsilon = epsilon
+        self.sum_of_squares = None
+
+    def apply(self, theta, gradient, alpha):
+        if self.sum_of_squares is None:
+            self.sum_of_squares = [0.0] * len(theta)
+        sum_of_squares = self.sum_of_squares
+        for j, gradient_j in enumerate(gradient):
+            sum_of_squares[j] += gradient_j ** 2
+            theta[j] -= alpha * gradient_j / (math.sqrt(sum_of_squares[j]) + self.epsilon)
+
+
+class RMSProp(GradientStep):
+    """like AdaGrad, but with a decaying average of squared gradients, so
+    the steps don't shrink forever"""
+
+    def __init__(self, learning_rate=0.01, decay=0.9, schedule=None,
+                 epsilon=1e-8):
+        GradientStep.__init__(self, learning_rate, schedule)
+        self.decay = decay
+        self.epsilon = epsilon
+        self.mean_square = None
+
+    def apply(self, theta, gradient, alpha):
+        if self.mean_square is None:
+            self.mean_square = [0.0] * len(theta)
+        decay, mean_square = self.decay, self.mean_square
+        for j, gradient_j in enumerate(gradient):
+            mean_square[j] = decay * mean_square[j] + (1 - decay) * gradient_j ** 2
+            theta[j] -= alpha * gradient_j / (math.sqrt(mean_square[j]) + self.epsilon)
+
+
+class Adam(GradientStep):
+    """momentum on the gradient plus RMSProp scaling, with both running
+    averages corrected for starting at zero"""
+
+    def __init__(self, learning_rate=0.01, beta_1=0.9, beta_2=0.999,
+                 schedule=None, epsilon=1e-8):
+        GradientStep.__init__(self, learning_rate, schedule)
+        self.beta_1, self.beta_2 = beta_1, beta_2
+        self.epsilon = epsilon
+        self.mean = None
+        self.mean_square = None
+
+    def apply(self, theta, gradient, alpha):
+        if self.mean is None:
+            self.mean = [0.0] * len(theta)
+            self.mean_square = [0.0] * len(theta)
+        beta_1, beta_2 = self.beta_1, self.beta_2
+        mean, mean_square = self.mean, self.mean_square
+        bias_correction_1 = 1 - beta_1 ** self.t
+        bias_correction_2 = 1 - beta_2 ** self.t
+        for j, gradient_j in enumerate(gradient):
+            mean[j] = beta_1 * mean[j] + (1 - beta_1) * gradient_j
+            mean_square[j] = beta_2 * mean_square[j] + (1 - beta_2) * gradient_j ** 2
+            theta[j] -= (alpha * (mean[j] / bias_correction_1) /
+                         (math.sqrt(mean_square[j] / bias_correction_2) + self.epsilon))
+
+
+#
+# learning rate schedules: functions from the step number t (from 1) to a
+# multiplier for the learning rate
+#
+
+def step_schedule(steps_per_drop, factor=0.5):
+    """multiply by factor every steps_per_drop steps"""
+    return lambda t: factor ** (t // steps_per_drop)
+
+
+def cosine_schedule(total_steps, min_multiplier=0.0):
+    """fall from 1 to min_multiplier along half a cosine over total_steps"""
+    def multiplier(t):
+        progress = min(t, total_steps) / total_steps
+        return min_multiplier + (1 - min_multiplier) * (1 + math.cos(math.pi * progress)) / 2
+    return multiplier
+
+
+def warmup_schedule(warmup_steps, then=None):
+    """ramp up linearly over warmup_steps, then follow schedule then"""
+    def multiplier(t):
+        if t <= warmup_steps:
+            return t / warmup_steps
+        return then(t - warmup_steps) if then is not None else 1
+    return multiplier
+
+
+def epochs_to_tolerance(target_fn, gradient_fn, x, y, theta_0, optimizer,
+                        target_value, tolerance=0.01, batch_size=1,
+                        max_epochs=500):
+    """how many epochs of a TrainingRun with optimizer (so the same steps,
+    and step-size decay, as minimize_stochastic or minimize_mini_batch) it
+    takes for the summed target_fn to come within tolerance (relative) of
+    target_value, or None if it takes more than max_epochs"""
+    goal = target_value + tolerance * abs(target_value)
+    run = TrainingRun(target_fn, gradient_fn, x, y, theta_0,
+                      optimizer=optimizer, batch_size=batch_size,
+                      patience=max_epochs + 1)
+    for epoch in range(max_epochs + 1):
+        try:
+            run.run_epoch()             # scores theta, then steps
+        except OverflowError:
+            return None                 # diverged
+        value = run.metrics[-1]["loss"]
+        if value <= goal:
+            return epoch                # the epochs before this one did it
+        if math.isnan(value) or math.isinf(value):
+            return None                 # diverged
+    return None
+
+
+def benchmark_optimizers(target_fn, gradient_fn, x, y, theta_0, target_value,
+                         optimizers, **kwargs):
+    """epochs_to_tolerance for each of a dict of name -> optimizer factory"""
+    results = {}
+    for name, make_optimizer in optimizers.iteritems():
+        random.seed(0)
+        results[name] = epochs_to_tolerance(target_fn, gradient_fn, x, y,
+                                            theta_0, make_optimizer(),
+                                            target_value, **kwargs)
+    return results
+
+
+#
+# data-parallel batch objectives
+#
+
+def _shard_worker(connection, target_fn, gradient_fn, x, y):
+    """runs in a worker process, holding one shard of the data, and answers
+    (what, theta) requests with sums over the shard until sent None"""
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        what, theta = request
+        value = gradient = None
+        try:
+            if what in ("value", "both"):
+                value = sum(target_fn(x_i, y_i, theta) for x_i, y_i in zip(x, y))
+            if what in ("gradient", "both"):
+                gradient = sum_of_gradients(gradient_fn, x, y, theta)
+        except Exception as e:
+            # send it back to be raised there (minimize_batch's safe()
+            # relies on catching overflows), and stay alive
+            connection.send(e)
+        else:
+            connection.send((value, gradient))
+    connection.close()
+
+
+class DataParallel:
+    """the summed target_fn(x_i, y_i, theta) and gradient_fn(x_i, y_i, theta)
+    over all the data, with the data split into one shard per worker
+    process; the shards are sent once and stay in the workers, so each
+    call only sends theta out and one partial sum per shard back"""
+    """self.target_fn and self.gradient_fn take just theta, so they can be
+    handed to minimize_batch, maximize_batch or minimize_lbfgs in place of
+    partial(logistic_log_likelihood, x, y) and the like; close() when done"""
+
+    def __init__(self, target_fn, gradient_fn, x, y, processes=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        shard_size = int(math.ceil(len(x) / processes))
+        self.connections, self.workers = [], []
+        for start in range(0, len(x), shard_size):
+            end = start + shard_size
+            connection, worker_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_shard_worker,
+                                             args=(worker_connection, target_fn,
+                                                   gradient_fn, x[start:end],
+                                                   y[start:end]))
+            worker.daemon = True        # don't outlive us if we forget close()
+            worker.start()
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def all_reduce(self, what, theta):
+        """sends the request to every shard before waiting on any of them,
+        so they all work at once, then sums their answers"""
+        for connection in self.connections:
+            connection.send((what, list(theta)))
+        value, gradient = 0, [0.0] * len(theta)
+        # collect every answer before raising, so none is left in a pipe
+        answers = [connection.recv() for connection in self.connections]
+        for answer in answers:
+            if isinstance(answer, Exception):
+                raise answer
+        for shard_value, shard_gradient in answers:
+            if shard_value is not None:
+                value += shard_value
+            if shard_gradient is not None:
+                gradient = vector_add(gradient, shard_gradient)
+        return value, gradient
+
+    def target_fn(self, theta):
+        return self.all_reduce("value", theta)[0]
+
+    def gradient_fn(self, theta):
+        return self.all_reduce("gradient", theta)[1]
+
+    def value_and_gradient(self, theta):
+        """both in one round trip"""
+        return self.all_reduce("both", theta)
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(None)
+            connection.close()
+        for worker in self.workers:
+            worker.join()
+        self.connections, self.workers = [], []
+
+
+def split_value_and_gradient(value_and_gradient_fn):
+    """turns a fused theta -> (value, gradient) function, such as
+    DataParallel.value_and_gradient, into a (target_fn, gradient_fn) pair
+    that share one evaluation whenever they're called at the same theta
+    one after the other (as minimize_lbfgs's line search does)"""
+    last = [None, None]                 # theta, (value, gradient)
+
+    def evaluate(theta):
+        if last[0] != theta:
+            last[:] = [list(theta), value_and_gradient_fn(theta)]
+        return last[1]
+
+    return (lambda theta: evaluate(theta)[0],
+            lambda theta: evaluate(theta)[1])
+
+
+#
+# training runs: checkpoints, resuming and early stopping
+#
+
+class TrainingRun:
+    """minimize_stochastic as a run of epochs that can be interrupted and
+    picked up again: every checkpoint_every epochs theta, the step size,
+    the best theta so far, the optimizer's state and rng's state are
+    written to checkpoint_path, and a TrainingRun built with the same
+    arguments resumes from there (the optimizer and rng must be fresh
+    ones of the same kind, since only their state is saved)"""
+    """each epoch is scored by validation_fn(theta) if given, or by the
+    summed target_fn on the training data otherwise; as in
+    minimize_stochastic, an improvement resets the step size to alpha_0
+    and anything else shrinks it by 10%, and the run stops after patience
+    epochs without improvement (or max_epochs in all); to maximize,
+    pass negate(target_fn), negate_all(gradient_fn) and a negated
+    validation_fn"""
+
+    def __init__(self, target_fn, gradient_fn, x, y, theta_0, alpha_0=0.01,
+                 optimizer=None, batch_size=1, validation_fn=None,
+                 patience=100, max_epochs=None, checkpoint_path=None,
+                 checkpoint_every=10, metrics_path=None, rng=random):
+        self.target_fn = target_fn
+        self.gradient_fn = gradient_fn
+        self.data = zip(x, y)
+        self.alpha_0 = alpha_0
+        self.optimizer = optimizer
+        self.batch_size = batch_size
+        self.validation_fn = validation_fn
+        self.patience = patience
+        self.max_epochs = max_epochs
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.metrics_path = metrics_path
+        self.rng = rng
+
+        self.epoch = 0
+        self.theta = list(theta_0)
+        self.alpha = alpha_0
+        self.best_theta, self.best_value = None, float("inf")
+        self.epochs_with_no_improvement = 0
+        self.metrics = []                   # one dict per epoch
+
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            self.restore()
+
+    def finished(self):
+        return (self.epochs_with_no_improvement >= self.patience or
+                (self.max_epochs is not None and self.epoch >= self.max_epochs))
+
+    def run(self):
+        """runs epochs until finished, and returns the best theta"""
+        while not self.finished():
+            self.run_epoch()
+            if (self.checkpoint_path is not None and
+                    self.epoch % self.checkpoint_every == 0):
+                self.checkpoint()
+        if self.checkpoint_path is not None:
+            self.checkpoint()
+        return self.best_theta
+
+    def run_epoch(self):
+        start = time.time()
+        loss = sum(self.target_fn(x_i, y_i, self.theta) for x_i, y_i in self.data)
+        if self.validation_fn is not None:
+            value = self.validation_fn(self.theta)
+        else:
+            value = loss
+        if value < self.best_value:
+            self.best_theta, self.best_value = self.theta, value
+            self.epochs_with_no_improvement = 0
+            self.alpha = self.alpha_0
+        else:
+            self.epochs_with_no_improvement += 1
+            self.alpha *= 0.9
+
+        indexes = range(len(self.data))
+        self.rng.shuffle(indexes)
+        points = (self.data[i] for i in indexes)
+        for x_batch, y_batch in batches(points, self.batch_size):
+            gradient = sum_of_gradients(self.gradient_fn, x_batch, y_batch, self.theta)
+            if len(x_batch) > 1:
+                gradient = [gradient_j / len(x_batch) for gradient_j in gradient]
+            if self.optimizer is None:
+                self.theta = vector_subtract(self.theta,
+                                             scalar_multiply(self.alpha, gradient))
+            else:
+                self.theta = list(self.theta)   # best_theta may still be the old one
+                self.optimizer.update(self.theta, gradient,
+                                      self.alpha / self.alpha_0)
+
+        self.epoch += 1
+        self.log({ "epoch": self.epoch,
+                   "loss": loss,
+                   "validation": value if self.validation_fn is not None else None,
+                   "step_size": self.step_size(),
+                   "seconds": time.time() - start })
+
+    def step_size(self):
+        """the step size this epoch used (before any optimizer schedule)"""
+        if self.optimizer is None:
+            return self.alpha
+        return self.optimizer.learning_rate * self.alpha / self.alpha_0
+
+    def log(self, metrics):
+        self.metrics.append(metrics)
+        if self.metrics_path is not None:
+            with open(self.metrics_path, "a") as f:
+                f.write(json.dumps(metrics, sort_keys=True) + "\n")
+
+    def state(self):
+        optimizer_state = None
+        if self.optimizer is not None:
+            # everything but the schedule, which is a function
+            optimizer_state = dict((name, value)
+                                   for name, value in vars(self.optimizer).iteritems()
+                                   if not callable(value))
+        return { "epoch": self.epoch,
+                 "theta": self.theta,
+                 "alpha": self.alpha,
+                 "best_theta": self.best_theta,
+                 "best_value": self.best_value,
+                 "epochs_with_no_improvement": self.epochs_with_no_improvement,
+                 "metrics": self.metrics,
+                 "optimizer": optimizer_state,
+                 "rng": self.rng.getstate() }
+
+    def checkpoint(self):
+        """writes the state to a temporary file and renames it over the
+        checkpoint, so a crash mid-write leaves the last checkpoint intact"""
+        temporary_path = self.checkpoint_path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            cPickle.dump(self.state(), f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temporary_path, self.checkpoint_path)
+
+    def restore(self):
+        with open(self.checkpoint_path, "rb") as f:
+            state = cPickle.load(f)
+        self.epoch = state["epoch"]
+        self.theta = state["theta"]
+        self.alpha = state["alpha"]
+        self.best_theta = state["best_theta"]
+        self.best_value = state["best_value"]
+        self.epochs_with_no_improvement = state["epochs_with_no_improvement"]
+        self.metrics = state["metrics"]
+        if self.optimizer is not None and state["optimizer"] is not None:
+            vars(self.optimizer).update(state["optimizer"])
+        self.rng.setstate(state["rng"])
+        if self.metrics_path is not None:
+            # drop anything logged after the checkpoint, those epochs rerun
+            with open(self.metrics_path, "w") as f:
+                for metrics in self.metrics:
+                    f.write(json.dumps(metrics, sort_keys=True) + "\n")
+
+
 if __name__ == "__main__":
     print "Using the gradient"
     v = [random.randint(-10,10) for i in range(3)]
@@ -161,3 +1030,24 @@ if __name__ == "__main__":
     v = minimize_batch(sum_of_squares, sum_of_squares_gradient, v)
     print "minimum v", v
     print "minimum value", sum_of_squares(v)
+    print
+    print "using minimize_batch with backtracking line search"
+    v = [random.randint(-10,10) for i in range(3)]
+    v = minimize_batch(sum_of_squares, sum_of_squares_gradient, v,
+                       line_search="backtracking")
+    print "minimum v", v
+    print "minimum value", sum_of_squares(v)
+    print
+    print "using minimize_lbfgs"
+    v = [random.randint(-10,10) for i in range(3)]
+    v = minimize_lbfgs(sum_of_squares, sum_of_squares_gradient, v)
+    print "minimum v", v
+    print "minimum value", sum_of_squares(v)
+    print
+    print "estimated gradients of sum_of_squares at [1, 2, 3] (exact is [2, 4, 6])"
+    for method in ["forward", "central", "complex"]:
+        print method, estimate_gradient(sum_of_squares, [1, 2, 3], method=method)
+    print
+    print "seconds per gradient in 200 dimensions, and largest error:"
+    for name, result in sorted(benchmark_estimate_gradient().items()):
+        print name, result
@@ -1,29 +1,43 @@
-# This code throws an error:
-# TypeError: unsupported operand type(s) for -: 'list' and 'float'
-# and I haven't been able to figure out how to fix it.
-# The author's source is at https://github.com/joelgrus/data-science-from-scratch/blob/master/code/logistic_regression.py
-
 from __future__ import division
 from collections import Counter
 from functools import partial
-from linear_algebra import dot, vector_add
-from gradient_descent import maximize_stochastic, maximize_batch
+from linear_algebra import dot
+from gradient_descent import maximize_stochastic, maximize_batch, maximize_lbfgs, negate, \
+                             negate_all, DataParallel, split_value_and_gradient, \
+                             benchmark_optimizers, GradientStep, Momentum, Nesterov, \
+                             AdaGrad, RMSProp, Adam, warmup_schedule, cosine_schedule
 from working_with_data import rescale
 from machine_learning import train_test_split
 from multiple_regression import estimate_beta, predict
 import math, random
 
 def logistic(x):
-    return 1.0 / (1 + math.exp(-x))
+    # written so that math.exp only ever sees a negative number,
+    # and can't overflow however large the margin is
+    if x >= 0:
+        return 1.0 / (1 + math.exp(-x))
+    else:
+        e = math.exp(x)
+        return e / (1 + e)
 
 def logistic_prime(x):
     return logistic(x) * (1 - logistic(x))
 
+def log_logistic(x):
+    """math.log(logistic(x)), without the overflow in logistic for very
+    negative x or the log(0) once logistic(x) rounds to 0 (or 1 - logistic(x),
+    for log_logistic(-x), rounds to 0)"""
+    if x >= 0:
+        return -math.log1p(math.exp(-x))
+    else:
+        return x - math.log1p(math.exp(x))
+
 def logistic_log_likelihood_i(x_i, y_i, beta):
+    # log(1 - logistic(m)) is log(logistic(-m))
     if y_i == 1:
-        return math.log(logistic(dot(x_i, beta)))
+        return log_logistic(dot(x_i, beta))
     else:
-        return math.log(1 - logistic(dot(x_i, beta)))
+        return log_logistic(-dot(x_i, beta))
 
 def logistic_log_likelihood(x, y, beta):
     return sum(logistic_log_likelihood_i(x_i, y_i, beta)
@@ -38,14 +52,72 @@ def logistic_log_partial_ij(x_i, y_i, beta, j):
 def logistic_log_gradient_i(x_i, y_i, beta):
     """the gradient of the log likelihood
     corresponding to the i-th data point"""
+    """(every partial is logistic_log_partial_ij, but the margin
+    dot(x_i, beta) is computed once instead of once per partial)"""
 
-    return [logistic_log_partial_ij(x_i, y_i, beta, j)
-            for j, _ in enumerate(beta)]
+    residual = y_i - logistic(dot(x_i, beta))
+    return [residual * x_ij for x_ij in x_i]
 
 def logistic_log_gradient(x, y, beta):
-    return reduce(vector_add,
-                  [logistic_log_gradient_i(x_i, y_i, beta)
-                   for x_i, y_i in zip(x,y)])
+    """the sum of the logistic_log_gradient_i, added up in place"""
+    gradient = [0.0] * len(beta)
+    for x_i, y_i, margin in zip(x, y, margins(x, beta)):
+        residual = y_i - logistic(margin)
+        for j, x_ij in enumerate(x_i):
+            gradient[j] += residual * x_ij
+    return gradient
+
+def margins(x, beta):
+    """dot(x_i, beta) for every row of x, that is, the product x * beta"""
+    return [dot(x_i, beta) for x_i in x]
+
+def logistic_log_likelihood_and_gradient(x, y, beta):
+    """the log likelihood and its gradient in one pass over the data,
+    computing each margin once and adding up the gradient in place"""
+    value = 0.0
+    gradient = [0.0] * len(beta)
+    for x_i, y_i, margin in zip(x, y, margins(x, beta)):
+        if y_i == 1:
+            value += log_logistic(margin)
+        else:
+            value += log_logistic(-margin)
+        residual = y_i - logistic(margin)
+        for j, x_ij in enumerate(x_i):
+            gradient[j] += residual * x_ij
+    return value, gradient
+
+def benchmark_logistic_kernels(n=2000, d=20, repeats=3):
+    """seconds for the log likelihood and gradient of n random points in d
+    dimensions: the original per-partial gradient (reduce over
+    logistic_log_partial_ij), the current separate functions, and the
+    fused one"""
+    import time
+    x = [[1] + [random.gauss(0, 1) for _ in range(d - 1)] for _ in range(n)]
+    y = [random.randint(0, 1) for _ in range(n)]
+    beta = [random.gauss(0, 1) for _ in range(d)]
+
+    def per_partial():
+        logistic_log_likelihood(x, y, beta)
+        return reduce(lambda v, w: [v_j + w_j for v_j, w_j in zip(v, w)],
+                      [[logistic_log_partial_ij(x_i, y_i, beta, j)
+                        for j, _ in enumerate(beta)]
+                       for x_i, y_i in zip(x, y)])
+
+    def separate():
+        logistic_log_likelihood(x, y, beta)
+        return logistic_log_gradient(x, y, beta)
+
+    def fused():
+        return logistic_log_likelihood_and_gradient(x, y, beta)[1]
+
+    results = {}
+    for name, kernel in [("per_partial", per_partial), ("separate", separate),
+                         ("fused", fused)]:
+        start = time.time()
+        for _ in range(repeats):
+            kernel()
+        results[name] = (time.time() - start) / repeats
+    return results
 
 if __name__ == "__main__":
 
@@ -64,7 +136,7 @@ if __name__ == "__main__":
     print "logistic regression:"
 
     random.seed(0)
-    x_train, x_test, y_train, y_test = train_test_split(rescaled_x, y, 0.33)
+    x_train, y_train, x_test, y_test = train_test_split(rescaled_x, y, 0.33)
 
     # want to maximize log likelihood on the training data
     fn = partial(logistic_log_likelihood, x_train, y_train)
@@ -78,6 +150,20 @@ if __name__ == "__main__":
 
     print "beta_batch", beta_hat
 
+    print "beta_lbfgs", maximize_lbfgs(fn, gradient_fn, [1, 1, 1])
+
+    fused_fn, fused_gradient_fn = split_value_and_gradient(
+        partial(logistic_log_likelihood_and_gradient, x_train, y_train))
+    print "beta_lbfgs, fused", maximize_lbfgs(fused_fn, fused_gradient_fn, [1, 1, 1])
+
+    # the same, with the training data split between two worker processes
+    parallel = DataParallel(logistic_log_likelihood_i, logistic_log_gradient_i,
+                            x_train, y_train, processes=2)
+    print "beta_batch, data parallel", maximize_batch(parallel.target_fn,
+                                                      parallel.gradient_fn,
+                                                      [1, 1, 1])
+    parallel.close()
+
     beta_0 = [1, 1, 1]
     beta_hat = maximize_stochastic(logistic_log_likelihood_i,
                                logistic_log_gradient_i,
@@ -104,3 +190,29 @@ if __name__ == "__main__":
 
     print "precision", precision
     print "recall", recall
+
+    print
+    print "epochs to get within 1% of the batch optimum's negative log likelihood:"
+
+    optimizers = {
+        "sgd": lambda: GradientStep(1),
+        "momentum": lambda: Momentum(0.1),
+        "nesterov": lambda: Nesterov(0.1),
+        "adagrad": lambda: AdaGrad(1),
+        "rmsprop": lambda: RMSProp(0.1),
+        "adam": lambda: Adam(0.1),
+        "adam, warmup + cosine": lambda: Adam(0.1, schedule=warmup_schedule(
+            20, then=cosine_schedule(2000, 0.1))) }
+
+    beta_batch = maximize_batch(partial(logistic_log_likelihood, rescaled_x, y),
+                                partial(logistic_log_gradient, rescaled_x, y),
+                                [1, 1, 1])
+    print benchmark_optimizers(negate(logistic_log_likelihood_i),
+                               negate_all(logistic_log_gradient_i),
+                               rescaled_x, y, [1, 1, 1],
+                               -logistic_log_likelihood(rescaled_x, y, beta_batch),
+                               optimizers, batch_size=10)
+
+    print
+    print "seconds per log likelihood and gradient, 2000 points in 20 dimensions:"
+    print benchmark_logistic_kernels()
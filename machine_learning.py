@@ -3,11 +3,11 @@ from collections import Counter
 import math, random
 
 
-def split_data(data, prob):
+def split_data(data, prob, rng=random):
     """ split data into fractions [prob, 1 - prob] """
     results = [], []
     for row in data:
-        results[0 if random.random() < prob else 1].append(row)
+        results[0 if rng.random() < prob else 1].append(row)
     return results
 
 
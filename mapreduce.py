@@ -1,8 +1,12 @@
 from __future__ import division
-import math, random, re, datetime
+import math, random, re, datetime, operator, heapq, tempfile, cPickle, csv
+import hashlib, os, time, json, types
 from collections import defaultdict, Counter
 from functools import partial
+from itertools import groupby
+from operator import itemgetter
 from naive_bayes import tokenize
+from sketches import HyperLogLog, CountMinSketch, SpaceSaving
 
 
 def word_count_old(documents):
@@ -38,18 +42,489 @@ def word_count(documents):
             for output in wc_reducer(word, counts)]
 
 
-def map_reduce(inputs, mapper, reducer):
+def map_reduce(inputs, mapper, reducer, combiner=None, split_size=1000,
+               max_buffered_pairs=None, stats=None, num_salts=1, hot_keys=None):
     """ runs MapReduce on the inputs using mapper and reducer """
+    """ inputs are handed to the mapper split_size at a time, and each split's
+        output is shrunk before the shuffle: by combiner if one is given,
+        otherwise by in-mapper aggregation if reducer is associative """
+    """ if max_buffered_pairs is given, the shuffle holds at most that many
+        pairs in memory, spilling the rest to disk, and reducer gets its
+        values as a generator instead of a list """
+    """ if stats is a JobStats, it records timings, counts and key skew """
+    """ if num_salts > 1 (for an associative reducer only), each hot key's
+        values are spread over num_salts reducer keys as they're collected,
+        and the partial results reduced again at the end; the hot keys are
+        hot_keys if given, or else spotted as the pairs go by (see KeySalter) """
 
-    collector = defaultdict(list)
+    salter = make_salter(reducer, num_salts, hot_keys)
+    collector = run_mappers(inputs, mapper, reducer, combiner, split_size,
+                            max_buffered_pairs, stats, salter)
+
+    return list(run_reducers(collector.groups(), reducer, stats, salter))
+
+
+def stream_map_reduce(inputs, mapper, reducer, combiner=None,
+                      split_size=1000, max_buffered_pairs=None, stats=None,
+                      num_salts=1, hot_keys=None):
+    """ like map_reduce, but generates the reducer outputs lazily instead of
+        returning a list, and always hands reducer an iterator of values """
+    """ the outputs can go straight into a sink (write_outputs,
+        insert_outputs) or be the inputs of another stream_map_reduce """
+
+    salter = make_salter(reducer, num_salts, hot_keys)
+    collector = run_mappers(inputs, mapper, reducer, combiner, split_size,
+                            max_buffered_pairs, stats, salter)
+
+    groups = ((key, iter(values)) for key, values in collector.groups())
+
+    for output in run_reducers(groups, reducer, stats, salter):
+        yield output
+
+
+def run_mappers(inputs, mapper, reducer, combiner, split_size,
+                max_buffered_pairs, stats=None, salter=None):
+    """ runs the map phase and returns the filled shuffle """
+
+    aggregation_fn = associative_aggregation(reducer)
+
+    if max_buffered_pairs is None:
+        collector = MemoryShuffle()
+    else:
+        collector = ExternalShuffle(max_buffered_pairs)
+
+    if stats is not None:
+        collector = InstrumentedShuffle(collector, stats)
+
+    for split in partition(inputs, split_size):
+        pairs = (pair
+                 for input in split
+                 for pair in mapper(input))
+
+        if stats is not None:
+            # run the mapper to completion here so its time is its own
+            with stats.timer("map"):
+                pairs = list(pairs)
+                stats.pairs_emitted += len(pairs)
+
+        with maybe_timer(stats, "combine"):
+            if combiner is not None:
+                pairs = combine(pairs, combiner)
+            elif aggregation_fn is not None:
+                pairs = aggregate_in_mapper(pairs, aggregation_fn)
+
+        for key, value in pairs:
+            if salter is not None:
+                key = salter.salt(key)
+            collector.add(key, value)
+
+    if stats is not None and salter is not None:
+        stats.salted_keys = list(salter.salted_keys)
+    return collector
+
+
+def run_reducers(groups, reducer, stats=None, salter=None):
+    """ generates the outputs of reducer over the shuffled (key, values) groups """
+
+    def reduce_groups():
+        partial_results = defaultdict(list)     # salted key -> partial results
+        for key, values in groups:
+            if salter is not None and salter.was_salted(key):
+                key = salter.unsalt(key)
+                partial_results[key].extend(result
+                                            for _, result in reducer(key, values))
+            else:
+                for output in reducer(key, values):
+                    yield output
+        # a hot key's num_salts (or so) partial results, reduced together
+        for key, results in partial_results.iteritems():
+            for output in reducer(key, results):
+                yield output
+
+    outputs = reduce_groups()
+
+    if stats is not None:
+        outputs = stats.timed("reduce", outputs)
+
+    for output in outputs:
+        if stats is not None:
+            stats.outputs += 1
+        yield output
+
+
+##
+## Salting hot keys
+##
+
+
+class SaltedKey(object):
+    """ a hot key plus the salt that picks one of its reducer keys; a class
+        of its own, so it can never be equal to a key the mapper emitted """
+
+    def __init__(self, key, salt):
+        self.key = key
+        self.salt = salt
+
+    def __eq__(self, other):
+        return (isinstance(other, SaltedKey) and
+                (self.key, self.salt) == (other.key, other.salt))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((SaltedKey, self.key, self.salt))
+
+    def __cmp__(self, other):
+        # ExternalShuffle sorts by key, so the order has to be total
+        if isinstance(other, SaltedKey):
+            return cmp((self.key, self.salt), (other.key, other.salt))
+        return cmp("SaltedKey", type(other).__name__)
+
+    def __reduce__(self):
+        # pickles (spilled runs) as just the class and the two fields
+        return SaltedKey, (self.key, self.salt)
+
+    def __repr__(self):
+        return "SaltedKey(%r, %r)" % (self.key, self.salt)
+
+
+class KeySalter:
+    """ rewrites a hot key to SaltedKey(key, 0), ..., SaltedKey(key, num_salts - 1)
+        in turn, before it reaches the shuffle, so that its values are spread
+        over num_salts reducer keys instead of all landing on one """
+    """ the hot keys are hot_keys if given; otherwise a key turns hot once it
+        has more than num_salts pairs and more than hot_key_share of all the
+        pairs so far (as counted by a SpaceSaving summary, so in fixed
+        memory), and stays hot; pairs it had before that keep the plain key """
+
+    def __init__(self, num_salts, hot_keys=None, hot_key_share=0.1,
+                 capacity=100):
+        self.num_salts = num_salts
+        self.hot_keys = set(hot_keys) if hot_keys is not None else None
+        self.hot_key_share = hot_key_share
+        self.summary = SpaceSaving(capacity)
+        self.pairs_seen = 0
+        self.salted_keys = set()
+        self.next_salt = {}                 # salted key -> its next salt
+
+    def is_hot(self, key):
+        if self.hot_keys is not None:
+            return key in self.hot_keys
+        self.pairs_seen += 1
+        self.summary.add(key)
+        count = self.summary.counts.get(key, 0)
+        return (key in self.salted_keys or
+                (count > self.num_salts and
+                 count > self.hot_key_share * self.pairs_seen))
 
+    def salt(self, key):
+        if not self.is_hot(key):
+            return key
+        self.salted_keys.add(key)
+        salt = self.next_salt.get(key, 0)
+        self.next_salt[key] = (salt + 1) % self.num_salts
+        return SaltedKey(key, salt)
+
+    def was_salted(self, key):
+        """ whether a shuffled key's reducer output is only a partial result """
+        return isinstance(key, SaltedKey) or key in self.salted_keys
+
+    def unsalt(self, key):
+        return key.key if isinstance(key, SaltedKey) else key
+
+
+def make_salter(reducer, num_salts, hot_keys=None):
+    """ a KeySalter if num_salts > 1, else None; salting relies on being able
+        to reduce partial results again, so reducer must be associative """
+    if num_salts <= 1:
+        return None
+    if associative_aggregation(reducer) is None:
+        raise ValueError("only an associative reducer (sum, max or min) "
+                         "can have its keys salted")
+    return KeySalter(num_salts, hot_keys)
+
+
+def partition(inputs, split_size):
+    """ groups the inputs into lists of (at most) split_size, one per mapper """
+    split = []
     for input in inputs:
-        for key, value in mapper(input):
-            collector[key].append(value)
+        split.append(input)
+        if len(split) == split_size:
+            yield split
+            split = []
+    if split:
+        yield split
+
+
+def combine(pairs, combiner):
+    """ groups one split's (key, value) pairs and runs combiner on each group """
+    grouped = defaultdict(list)
+    for key, value in pairs:
+        grouped[key].append(value)
 
     return [output
-            for key, values in collector.iteritems()
-            for output in reducer(key, values)]
+            for key, values in grouped.iteritems()
+            for output in combiner(key, values)]
+
+
+def aggregate_in_mapper(pairs, aggregation_fn):
+    """ folds one split's (key, value) pairs into a partial aggregate per key,
+        so no per-key list of values is ever built """
+    partials = {}
+    for key, value in pairs:
+        if key in partials:
+            partials[key] = aggregation_fn(partials[key], value)
+        else:
+            partials[key] = value
+    return partials.iteritems()
+
+
+##
+## Shuffling
+##
+
+
+class MemoryShuffle:
+    """ groups (key, value) pairs by key in a dict of lists """
+
+    def __init__(self):
+        self.values_by_key = defaultdict(list)
+
+    def add(self, key, value):
+        self.values_by_key[key].append(value)
+
+    def groups(self):
+        """ yields (key, values) pairs, values being a list; each key is
+            dropped as it is handed out, so consumed groups can be freed """
+        while self.values_by_key:
+            yield self.values_by_key.popitem()
+
+
+class ExternalShuffle:
+    """ groups (key, value) pairs by key in bounded memory: pairs are
+        buffered up to max_buffered_pairs, then sorted by key and spilled
+        to a temp file as a run, and the runs are k-way merged at the end """
+
+    def __init__(self, max_buffered_pairs):
+        self.max_buffered_pairs = max_buffered_pairs
+        self.buffer = []
+        self.runs = []        # temp files, each holding one sorted run
+
+    def add(self, key, value):
+        self.buffer.append((key, value))
+        if len(self.buffer) >= self.max_buffered_pairs:
+            self.spill()
+
+    def spill(self):
+        """ writes the buffer to a temp file, sorted by key """
+        run = tempfile.TemporaryFile()
+        for pair in sort_by_key(self.buffer):
+            cPickle.dump(pair, run, cPickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        self.runs.append(run)
+        self.buffer = []
+
+    def groups(self):
+        """ yields (key, values) pairs, values being a generator that
+            streams that key's values out of the merged runs """
+        runs = [read_run(run) for run in self.runs]
+        runs.append(iter(sort_by_key(self.buffer)))
+        self.buffer = []
+
+        # tag each pair with its run number and position in the run, so the
+        # merge never has to compare values, and each key's values come out
+        # in the order they were emitted
+        tagged_runs = [tag_run(run, run_number)
+                       for run_number, run in enumerate(runs)]
+        merged = heapq.merge(*tagged_runs)
+
+        for key, group in groupby(merged, itemgetter(0)):
+            yield key, (value for _, _, _, value in group)
+
+        for run in self.runs:
+            run.close()           # temp files are deleted on close
+        self.runs = []
+
+
+def tag_run(run, run_number):
+    """ generates (key, run_number, position, value) for the pairs of a run;
+        a function of its own so that each run keeps its own run_number
+        (generator expressions in a loop would all see the last one) """
+    for position, (key, value) in enumerate(run):
+        yield key, run_number, position, value
+
+
+def sort_by_key(pairs):
+    """ sorts (key, value) pairs by key only, keeping the emission order of
+        values that share a key """
+    return sorted(pairs, key=itemgetter(0))
+
+
+def read_run(run):
+    """ generates the (key, value) pairs pickled into a spilled run """
+    while True:
+        try:
+            yield cPickle.load(run)
+        except EOFError:
+            return
+
+
+##
+## Instrumentation
+##
+
+
+class Timer:
+    """ accumulates wall-clock and CPU time over any number of runs """
+
+    def __init__(self):
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+
+    def __enter__(self):
+        self.wall_start, self.cpu_start = time.time(), time.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall_seconds += time.time() - self.wall_start
+        self.cpu_seconds += time.clock() - self.cpu_start
+
+
+class NullTimer:
+    """ a stand-in for Timer when nothing is being recorded """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def maybe_timer(stats, stage):
+    return stats.timer(stage) if stats is not None else NullTimer()
+
+
+class JobStats:
+    """ what happened during one map_reduce run: time per stage, how many
+        pairs were emitted, shuffled and output, how many bytes the shuffle
+        carried, and how many values each key received """
+
+    def __init__(self, hot_key_share=0.1, top_n=10):
+        self.hot_key_share = hot_key_share  # a key is hot above this share of pairs
+        self.top_n = top_n                  # how many keys the skew report lists
+        self.timers = {}
+        self.pairs_emitted = 0
+        self.pairs_shuffled = 0
+        self.bytes_shuffled = 0
+        self.outputs = 0
+        self.values_per_key = Counter()
+        self.salted_keys = []               # filled in by a KeySalter, if any
+
+    def timer(self, stage):
+        if stage not in self.timers:
+            self.timers[stage] = Timer()
+        return self.timers[stage]
+
+    def timed(self, stage, iterable):
+        """ passes iterable through, charging the time spent producing each
+            item (but not consuming it) to stage """
+        iterator = iter(iterable)
+        while True:
+            with self.timer(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def record_pair(self, key, value):
+        self.pairs_shuffled += 1
+        self.bytes_shuffled += len(cPickle.dumps((key, value),
+                                                 cPickle.HIGHEST_PROTOCOL))
+        self.values_per_key[key] += 1
+
+    def is_hot(self, key):
+        return (self.values_per_key[key] > 1 and
+                self.values_per_key[key] > self.hot_key_share * self.pairs_shuffled)
+
+    def hot_keys(self):
+        """ the hot keys, e.g. to pass as hot_keys to the next run """
+        return [key for key in self.values_per_key if self.is_hot(key)]
+
+    def skew_report(self):
+        """ the largest keys and how far the largest is from the average """
+        num_keys = len(self.values_per_key)
+        mean_values = self.pairs_shuffled / num_keys if num_keys else 0
+        top_keys = self.values_per_key.most_common(self.top_n)
+        max_values = top_keys[0][1] if top_keys else 0
+        return { "num_keys": num_keys,
+                 "mean_values_per_key": mean_values,
+                 "max_values_per_key": max_values,
+                 "skew": max_values / mean_values if mean_values else 0,
+                 "top_keys": [[repr(key), count] for key, count in top_keys],
+                 "hot_keys": map(repr, self.hot_keys()),
+                 "salted_keys": map(repr, self.salted_keys) }
+
+    def report(self):
+        return { "stages": dict((stage, { "wall_seconds": timer.wall_seconds,
+                                          "cpu_seconds": timer.cpu_seconds })
+                                for stage, timer in self.timers.iteritems()),
+                 "pairs_emitted": self.pairs_emitted,
+                 "pairs_shuffled": self.pairs_shuffled,
+                 "bytes_shuffled": self.bytes_shuffled,
+                 "outputs": self.outputs,
+                 "skew": self.skew_report() }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.report(), **kwargs)
+
+
+class InstrumentedShuffle:
+    """ wraps a shuffle, recording each pair and the time spent adding it;
+        handing out the groups (and any merging) is charged to reduce """
+
+    def __init__(self, shuffle, stats):
+        self.shuffle = shuffle
+        self.stats = stats
+
+    def add(self, key, value):
+        self.stats.record_pair(key, value)
+        with self.stats.timer("shuffle"):
+            self.shuffle.add(key, value)
+
+    def groups(self):
+        return self.shuffle.groups()
+
+
+##
+## Sinks
+##
+
+
+def write_outputs(outputs, filename):
+    """ writes (key, value) outputs to a tab-delimited file as they arrive,
+        returns the number of outputs written """
+    count = 0
+    with open(filename, 'wb') as f:
+        writer = csv.writer(f, delimiter='\t')
+        for key, value in outputs:
+            writer.writerow([key, value])
+            count += 1
+    return count
+
+
+def insert_outputs(outputs, table):
+    """ inserts each (key, value) output as a row of a two-column
+        databases.Table, returns the table """
+    for output in outputs:
+        table.insert(list(output))
+    return table
+
+
+##
+## Reducers
+##
 
 
 def reduce_with(aggregation_fn, key, values):
@@ -62,12 +537,209 @@ def values_reducer(aggregation_fn):
     return partial(reduce_with, aggregation_fn)
 
 
+# aggregations whose results can be aggregated again, mapped to
+# the equivalent function of two partial results
+ASSOCIATIVE_AGGREGATIONS = { sum: operator.add, max: max, min: min }
+
+
+def associative_aggregation(reducer):
+    """ if reducer is values_reducer(sum), values_reducer(max) or
+        values_reducer(min), returns the two-argument version of its
+        aggregation; otherwise returns None """
+    if isinstance(reducer, partial) and reducer.func is reduce_with:
+        return ASSOCIATIVE_AGGREGATIONS.get(reducer.args[0])
+    return None
+
+
 sum_reducer = values_reducer(sum)
 max_reducer = values_reducer(max)
 min_reducer = values_reducer(min)
 count_distinct_reducer = values_reducer(lambda values: len(set(values)))
 
 
+##
+## Multi-Stage Pipelines
+##
+
+
+class Pipeline:
+    """ a chain of map and map_reduce stages, run as consecutive jobs
+        that each feed their outputs to the next """
+    """ adjacent map stages are fused into the following job's mapper, and
+        if cache_dir is given each job's outputs are saved there, keyed by
+        the job and everything upstream of it, so a re-run only recomputes
+        the jobs that changed; from the first job that fingerprint can't
+        key reliably on, nothing is cached """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.stages = []
+
+    def map(self, mapper):
+        """ adds a stage with no shuffle: mapper turns each input into
+            zero or more outputs """
+        self.stages.append((mapper, None, None))
+        return self
+
+    def map_reduce(self, mapper, reducer, combiner=None):
+        """ adds a full MapReduce stage """
+        self.stages.append((mapper, reducer, combiner))
+        return self
+
+    def jobs(self):
+        """ returns (mapper, reducer, combiner) per job, with runs of map
+            stages fused into one mapper; a trailing run of map stages
+            becomes a job whose reducer is None """
+        jobs = []
+        pending_mappers = []
+        for mapper, reducer, combiner in self.stages:
+            pending_mappers.append(mapper)
+            if reducer is not None:
+                jobs.append((fuse_mappers(pending_mappers), reducer, combiner))
+                pending_mappers = []
+        if pending_mappers:
+            jobs.append((fuse_mappers(pending_mappers), None, None))
+        return jobs
+
+    def run(self, inputs):
+        """ runs every job, returning a generator of the last job's outputs """
+        if self.cache_dir is not None:
+            # read a generator of inputs once, for both the key and the jobs
+            inputs = list(inputs)
+            cache_key = hashlib.sha1(cPickle.dumps(inputs, 2)).hexdigest()
+        outputs = inputs
+
+        caching = self.cache_dir is not None
+        for mapper, reducer, combiner in self.jobs():
+            if caching:
+                try:
+                    job_fingerprint = fingerprint((mapper, reducer, combiner))
+                except Uncacheable:
+                    # this job's key would be unreliable, and so would
+                    # every later one, which builds on it
+                    caching = False
+            if caching:
+                cache_key = hashlib.sha1(cache_key + job_fingerprint).hexdigest()
+                cache_path = os.path.join(self.cache_dir, cache_key)
+                if os.path.exists(cache_path):
+                    # everything up to here is cached, so skip the work
+                    outputs = read_cached(cache_path)
+                    continue
+
+            if reducer is None:
+                outputs = (output
+                           for input in outputs
+                           for output in mapper(input))
+            else:
+                outputs = stream_map_reduce(outputs, mapper, reducer, combiner)
+
+            if caching:
+                outputs = write_cached(outputs, cache_path)
+
+        return outputs
+
+
+def fuse_mappers(mappers):
+    """ chains mappers into one, each feeding its outputs to the next """
+    if len(mappers) == 1:
+        return mappers[0]
+
+    first, rest = mappers[0], fuse_mappers(mappers[1:])
+    def fused_mapper(input):
+        for intermediate in first(input):
+            for output in rest(intermediate):
+                yield output
+    fused_mapper.fused = mappers    # so fingerprint can see what's inside
+    return fused_mapper
+
+
+class Uncacheable(Exception):
+    """ raised by fingerprint for things it can't reliably tell apart """
+    pass
+
+
+def global_names(code):
+    """ the global names code (or any function nested in it) might read """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= global_names(const)
+    return names
+
+
+def fingerprint(fn, seen=frozenset()):
+    """ a string that changes whenever fn's code, bound arguments, closure
+        or the globals it reads do; raises Uncacheable for anything else,
+        such as a callable instance, whose repr may be just an address """
+    if fn is None or isinstance(fn, (bool, int, long, float, complex, str, unicode)):
+        return repr(fn)
+    elif isinstance(fn, (tuple, list)):
+        return "(" + ",".join(fingerprint(item, seen) for item in fn) + ")"
+    elif isinstance(fn, dict):
+        return "{" + ",".join(sorted(fingerprint(item, seen)
+                                     for item in fn.iteritems())) + "}"
+    elif isinstance(fn, (set, frozenset)):
+        return "{" + ",".join(sorted(fingerprint(item, seen) for item in fn)) + "}"
+    elif hasattr(fn, "fused"):
+        return fingerprint(fn.fused, seen)
+    elif isinstance(fn, partial):
+        return fingerprint((fn.func, fn.args, fn.keywords or {}), seen)
+    elif isinstance(fn, types.FunctionType):
+        name = fn.__module__ + "." + fn.__name__
+        if fn in seen:
+            return name                 # a recursive reference
+        seen = seen | set([fn])
+        try:
+            closure = [cell.cell_contents for cell in fn.func_closure or ()]
+        except ValueError:
+            raise Uncacheable(name + " has an empty closure cell")
+        code = fn.func_code
+        builtins = fn.func_globals.get("__builtins__", {})
+        if isinstance(builtins, types.ModuleType):
+            builtins = vars(builtins)
+        referenced_globals = {}
+        for global_name in global_names(code):
+            # names that are neither are attribute names, which the code's
+            # own fingerprint (its co_names) already covers
+            if global_name in fn.func_globals:
+                referenced_globals[global_name] = fn.func_globals[global_name]
+            elif global_name in builtins:
+                referenced_globals[global_name] = builtins[global_name]
+        return fingerprint((name, code, fn.func_defaults or (),
+                            closure, referenced_globals), seen)
+    elif isinstance(fn, types.CodeType):
+        # fn's own code, or a nested function's in co_consts; co_code only
+        # holds indexes into the name tuples, so they go in too
+        return fingerprint((fn.co_code, fn.co_consts, fn.co_names,
+                            fn.co_varnames, fn.co_freevars, fn.co_cellvars),
+                           seen)
+    elif isinstance(fn, types.ModuleType):
+        return "module " + fn.__name__
+    elif isinstance(fn, (types.BuiltinFunctionType, type, types.ClassType)):
+        # builtins and classes are identified by where they're defined
+        return "%s.%s" % (getattr(fn, "__module__", None), fn.__name__)
+    else:
+        raise Uncacheable("can't fingerprint %r" % (fn,))
+
+
+def write_cached(outputs, cache_path):
+    """ passes outputs through, saving them to cache_path; the cache entry
+        only appears once every output has been written """
+    temp_path = cache_path + ".partial"
+    with open(temp_path, "wb") as f:
+        for output in outputs:
+            cPickle.dump(output, f, cPickle.HIGHEST_PROTOCOL)
+            yield output
+    os.rename(temp_path, cache_path)
+
+
+def read_cached(cache_path):
+    """ generates the outputs saved by write_cached """
+    with open(cache_path, "rb") as f:
+        for output in read_run(f):
+            yield output
+
+
 ##
 ## Analyzing Status Updates
 ##
@@ -141,6 +813,70 @@ distinct_likers_per_user = map_reduce(status_updates,
                                       count_distinct_reducer)
 
 
+##
+## Approximate Reducers
+##
+
+
+# these run in fixed memory per key, and the matching combiners turn each
+# mapper's values into a sketch, so the reducer merges one sketch per mapper
+# instead of seeing every value
+
+
+def hyperloglog_combiner(key, values):
+    """ summarises one mapper's values for key as a HyperLogLog """
+    sketch = HyperLogLog()
+    for value in values:
+        sketch.add(value)
+    yield (key, sketch)
+
+
+def approx_count_distinct_reducer(key, values):
+    """ like count_distinct_reducer, to within about 2%, taking either raw
+        values or HyperLogLogs from hyperloglog_combiner """
+    sketch = HyperLogLog()
+    for value in values:
+        if isinstance(value, HyperLogLog):
+            sketch.merge(value)
+        else:
+            sketch.add(value)
+    yield (key, sketch.count())
+
+
+def word_sketch_combiner(new_sketch, user, words_and_counts):
+    """ summarises one mapper's (word, count) pairs for user in new_sketch() """
+    sketch = new_sketch()
+    for word, count in words_and_counts:
+        sketch.add(word, count)
+    yield (user, sketch)
+
+
+def approx_most_popular_word_reducer(new_sketch, user, words_and_counts):
+    """ like most_popular_word_reducer, but counts words in new_sketch(), a
+        SpaceSaving or CountMinSketch, instead of a full Counter; takes
+        either (word, count) pairs or sketches from word_sketch_combiner """
+    sketch = new_sketch()
+    for value in words_and_counts:
+        if isinstance(value, (SpaceSaving, CountMinSketch)):
+            sketch.merge(value)
+        else:
+            word, count = value
+            sketch.add(word, count)
+
+    word, count = sketch.most_common(1)[0]
+
+    yield (user, (word, count))
+
+
+space_saving_word_reducer = partial(approx_most_popular_word_reducer,
+                                    partial(SpaceSaving, 10))
+space_saving_word_combiner = partial(word_sketch_combiner,
+                                     partial(SpaceSaving, 10))
+count_min_word_reducer = partial(approx_most_popular_word_reducer,
+                                 CountMinSketch)
+count_min_word_combiner = partial(word_sketch_combiner, CountMinSketch)
+
+
 ##
 ## Matrix Multiplication
 ##
@@ -173,6 +909,84 @@ def matrix_multiply_reducer(m, key, indexed_values):
         yield (key, sum_product)
 
 
+def block_matrix_multiply_mapper(m, block_size, element):
+    """ m is the common dimension, block_size the side of a tile """
+    """ sends each entry to the output tiles that need it rather than to every
+        output cell, so it is copied m / block_size times instead of m times """
+    matrix, i, j, value = element
+    num_blocks = int(math.ceil(m / block_size))
+
+    if matrix == "A":
+        # A_ij contributes to every tile in row-block i // block_size
+        for block_column in range(num_blocks):
+            yield ((i // block_size, block_column), element)
+    else:
+        # B_ij contributes to every tile in column-block j // block_size
+        for block_row in range(num_blocks):
+            yield ((block_row, j // block_size), element)
+
+
+def block_matrix_multiply_reducer(tile, elements):
+    """ multiplies the A rows and B columns of one tile as sparse matrices,
+        yielding ((i, j), C_ij) for every nonzero C_ij in the tile """
+    a_by_k = defaultdict(list)    # k -> [(i, A_ik)]
+    b_by_k = defaultdict(list)    # k -> [(j, B_kj)]
+    for matrix, i, j, value in elements:
+        if matrix == "A":
+            a_by_k[j].append((i, value))
+        else:
+            b_by_k[i].append((j, value))
+
+    tile_products = defaultdict(int)
+    for k, a_entries in a_by_k.iteritems():
+        for j, b_kj in b_by_k.get(k, []):
+            for i, a_ik in a_entries:
+                tile_products[(i, j)] += a_ik * b_kj
+
+    for cell, sum_product in tile_products.iteritems():
+        if sum_product != 0.0:
+            yield (cell, sum_product)
+
+
+def random_sparse_entries(matrix, m, nnz):
+    """ nnz random entries (matrix, i, j, value) of an m x m sparse matrix """
+    cells = set()
+    while len(cells) < nnz:
+        cells.add((random.randrange(m), random.randrange(m)))
+    return [(matrix, i, j, random.randint(1, 9)) for i, j in cells]
+
+
+def benchmark_matrix_multiply(m=10000, nnz=100, block_size=1000):
+    """ times cell-based and block-based MapReduce multiplication of two
+        random m x m matrices with nnz entries each, and counts the pairs
+        each one shuffles """
+
+    entries = (random_sparse_entries("A", m, nnz) +
+               random_sparse_entries("B", m, nnz))
+
+    cell_mapper = partial(matrix_multiply_mapper, m)
+    block_mapper = partial(block_matrix_multiply_mapper, m, block_size)
+
+    start = time.time()
+    cell_result = map_reduce(entries, cell_mapper,
+                             partial(matrix_multiply_reducer, m))
+    cell_time = time.time() - start
+
+    start = time.time()
+    block_result = map_reduce(entries, block_mapper,
+                              block_matrix_multiply_reducer)
+    block_time = time.time() - start
+
+    assert sorted(cell_result) == sorted(block_result)
+
+    return { "cell_pairs_shuffled": sum(1 for entry in entries
+                                          for _ in cell_mapper(entry)),
+             "block_pairs_shuffled": sum(1 for entry in entries
+                                           for _ in block_mapper(entry)),
+             "cell_seconds": cell_time,
+             "block_seconds": block_time }
+
+
 if __name__ == '__main__':
 
     documents = ["data science", "big data", "science fiction"]
@@ -194,6 +1008,45 @@ if __name__ == '__main__':
     print map_reduce(documents, wc_mapper, wc_reducer)
     print
 
+    print "Word count with wc_reducer as a combiner: "
+    print map_reduce(documents, wc_mapper, wc_reducer, combiner=wc_reducer)
+    print
+
+    print "Word count with sum_reducer (aggregated in the mapper): "
+    print map_reduce(documents, wc_mapper, sum_reducer)
+    print
+
+    print "Word count with a disk-spilling shuffle (2 pairs in memory): "
+    print map_reduce(documents, wc_mapper, wc_reducer,
+                     split_size=1, max_buffered_pairs=2)
+    print
+
+    print "Streamed word count, chained into a count of words per count: "
+    word_counts = stream_map_reduce(documents, wc_mapper, wc_reducer)
+    count_mapper = lambda (word, count): [(count, 1)]
+    print list(stream_map_reduce(word_counts, count_mapper, sum_reducer))
+    print
+
+    print "The same two jobs as a cached Pipeline, run twice: "
+    pipeline = (Pipeline(cache_dir=tempfile.mkdtemp())
+                .map_reduce(wc_mapper, wc_reducer)
+                .map_reduce(count_mapper, sum_reducer))
+    print list(pipeline.run(documents))
+    print list(pipeline.run(documents)), "(from cache)"
+    print
+
+    print "Instrumented word count: "
+    stats = JobStats(hot_key_share=0.2)
+    map_reduce(documents * 3, wc_mapper, sum_reducer, split_size=1, stats=stats)
+    print stats.to_json(indent=2, sort_keys=True)
+    print
+    print "The same, salting its hot keys over 2 reducer keys each: "
+    salted_stats = JobStats(hot_key_share=0.2)
+    map_reduce(documents * 3, wc_mapper, sum_reducer, split_size=1,
+               stats=salted_stats, num_salts=2, hot_keys=stats.hot_keys())
+    print salted_stats.to_json(indent=2, sort_keys=True)
+    print
+
     print "Data Science Days: "
     print data_science_days
     print
@@ -206,6 +1059,21 @@ if __name__ == '__main__':
     print distinct_likers_per_user
     print
 
+    print "Approximate Distinct Likers (HyperLogLog): "
+    print map_reduce(status_updates, liker_mapper,
+                     approx_count_distinct_reducer,
+                     combiner=hyperloglog_combiner, split_size=2)
+    print
+
+    print "Approximate User words (Space-Saving, Count-Min): "
+    print map_reduce(status_updates, words_per_user_mapper,
+                     space_saving_word_reducer,
+                     combiner=space_saving_word_combiner, split_size=2)
+    print map_reduce(status_updates, words_per_user_mapper,
+                     count_min_word_reducer,
+                     combiner=count_min_word_combiner, split_size=2)
+    print
+
     ## Matrix Multiplication
 
     entries = [("A", 0, 0, 3), ("A", 0, 1,  2),
@@ -218,3 +1086,15 @@ if __name__ == '__main__':
     print "entries: ", entries
     print "result: ", map_reduce(entries, mapper, reducer)
     print
+
+    block_mapper = partial(block_matrix_multiply_mapper, 3, 2)
+
+    print "Block MapReduce Matrix Multiplication (2 x 2 tiles): "
+    print "result: ", map_reduce(entries, block_mapper,
+                                 block_matrix_multiply_reducer)
+    print
+
+    print "Benchmark, 10k x 10k matrices with 100 nonzero entries each: "
+    random.seed(0)
+    print benchmark_matrix_multiply(m=10000, nnz=100, block_size=1000)
+    print
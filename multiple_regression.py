@@ -1,12 +1,16 @@
 from __future__ import division
 from collections import Counter
 from functools import partial
+from itertools import izip
 from linear_algebra import dot, vector_add
-from statistics import median, standard_deviation
+from statistics import median, standard_deviation, quantiles
 from probability import normal_cdf
-from gradient_descent import minimize_stochastic
+from gradient_descent import minimize_stochastic, minimize_mini_batch, minimize_lbfgs, \
+                             TrainingRun, benchmark_optimizers, GradientStep, Momentum, Nesterov, AdaGrad, RMSProp, Adam, \
+                             warmup_schedule, cosine_schedule
 from simple_linear_regression import total_sum_of_squares
-import math, random
+from sampling import choices, Sampler
+import math, random, multiprocessing
 
 
 def predict(x_i, beta):
@@ -26,6 +30,17 @@ def squared_error_gradient(x_i, y_i, beta):
     return [-2 * x_ij * error(x_i, y_i, beta) for x_ij in x_i]
 
 
+def squared_error_batch_gradient(x_batch, y_batch, beta):
+    """ the summed gradient of the squared errors of a batch, computing each
+        point's error once rather than once per coordinate """
+    gradient = [0.0] * len(beta)
+    for x_i, y_i in zip(x_batch, y_batch):
+        scale = -2 * error(x_i, y_i, beta)
+        for j, x_ij in enumerate(x_i):
+            gradient[j] += scale * x_ij
+    return gradient
+
+
 def estimate_beta(x, y):
     beta_initial = [random.random() for x_i in x[0]]
     return minimize_stochastic(squared_error,
@@ -36,14 +51,168 @@ def estimate_beta(x, y):
                                0.001)
 
 
+#
+## EXACT LEAST SQUARES ##
+#
+
+
+# estimate_beta searches for beta with stochastic gradient descent; these
+# solve for it directly, in one pass over the data that only keeps a
+# d x d summary (d = number of features), so x and y can be streamed
+
+
+class NormalEquations:
+    """ accumulates X^T X and X^T y, from which beta solves
+        (X^T X) beta = X^T y """
+
+    def __init__(self, num_features):
+        self.n = 0
+        self.xtx = [[0.0] * num_features for _ in range(num_features)]
+        self.xty = [0.0] * num_features
+
+    def update(self, x_i, y_i):
+        self.n += 1
+        for j, x_ij in enumerate(x_i):
+            if x_ij == 0: continue
+            xtx_j = self.xtx[j]
+            for k in range(j, len(x_i)):        # upper triangle only
+                xtx_j[k] += x_ij * x_i[k]
+            self.xty[j] += x_ij * y_i
+        return self
+
+    def merge(self, other):
+        self.n += other.n
+        for row, other_row in zip(self.xtx, other.xtx):
+            for k, value in enumerate(other_row):
+                row[k] += value
+        self.xty = vector_add(self.xty, other.xty)
+        return self
+
+    def solve(self, alpha=0.0):
+        """ beta by Cholesky factorization; alpha is a ridge penalty,
+            weighted like squared_error_ridge, which adds it once per point """
+        d = len(self.xty)
+        a = [[self.xtx[min(j, k)][max(j, k)] for k in range(d)]
+             for j in range(d)]
+        for j in range(1, d):                   # the intercept isn't penalized
+            a[j][j] += self.n * alpha
+        return cholesky_solve(cholesky(a), self.xty)
+
+
+def cholesky(a):
+    """ the lower-triangular L with L L^T = a, for symmetric positive
+        definite a """
+    d = len(a)
+    l = [[0.0] * d for _ in range(d)]
+    for j in range(d):
+        diagonal = a[j][j] - sum(l[j][k] ** 2 for k in range(j))
+        if diagonal <= 0:
+            raise ValueError("matrix is not positive definite "
+                             "(are some features collinear?)")
+        l[j][j] = math.sqrt(diagonal)
+        for i in range(j + 1, d):
+            l[i][j] = (a[i][j] - sum(l[i][k] * l[j][k] for k in range(j))) / l[j][j]
+    return l
+
+
+def cholesky_solve(l, b):
+    """ solves L L^T x = b by substituting forward, then backward """
+    d = len(b)
+    z = [0.0] * d
+    for i in range(d):
+        z[i] = (b[i] - sum(l[i][k] * z[k] for k in range(i))) / l[i][i]
+    x = [0.0] * d
+    for i in reversed(range(d)):
+        x[i] = (z[i] - sum(l[k][i] * x[k] for k in range(i + 1, d))) / l[i][i]
+    return x
+
+
+class StreamingQR:
+    """ keeps the R of a QR factorization of X, and Q^T y, rotating each new
+        row in with Givens rotations; slower than NormalEquations, but never
+        forms X^T X, which squares the condition number """
+
+    def __init__(self, num_features):
+        self.n = 0
+        self.r = [[0.0] * num_features for _ in range(num_features)]
+        self.qty = [0.0] * num_features
+
+    def update(self, x_i, y_i):
+        self.n += 1
+        self.rotate_in(list(x_i), y_i)
+        return self
+
+    def rotate_in(self, row, y_i):
+        """ zeroes row against R one column at a time, rotating R and Q^T y
+            along with it """
+        for j in range(len(row)):
+            if row[j] == 0: continue
+            r_j = self.r[j]
+            radius = math.hypot(r_j[j], row[j])
+            c, s = r_j[j] / radius, row[j] / radius
+            for k in range(j, len(row)):
+                r_j[k], row[k] = c * r_j[k] + s * row[k], c * row[k] - s * r_j[k]
+            self.qty[j], y_i = c * self.qty[j] + s * y_i, c * y_i - s * self.qty[j]
+
+    def merge(self, other):
+        """ the rows of other's R, with other's Q^T y, stand in for all of
+            other's data """
+        self.n += other.n
+        for r_j, qty_j in zip(other.r, other.qty):
+            self.rotate_in(list(r_j), qty_j)
+        return self
+
+    def solve(self, alpha=0.0):
+        """ beta by back substitution on R beta = Q^T y; alpha is a ridge
+            penalty, added as extra rows sqrt(n * alpha) * e_j """
+        d = len(self.qty)
+        if alpha:
+            penalized = StreamingQR(d).merge(self)
+            for j in range(1, d):               # the intercept isn't penalized
+                penalty_row = [0.0] * d
+                penalty_row[j] = math.sqrt(self.n * alpha)
+                penalized.rotate_in(penalty_row, 0.0)
+            return penalized.solve()
+
+        beta = [0.0] * d
+        for j in reversed(range(d)):
+            if self.r[j][j] == 0:
+                raise ValueError("R is singular (are some features collinear?)")
+            beta[j] = (self.qty[j] -
+                       sum(self.r[j][k] * beta[k] for k in range(j + 1, d))
+                       ) / self.r[j][j]
+        return beta
+
+
+def least_squares_beta(x, y, alpha=0.0, method="qr"):
+    """ solves for the beta that estimate_beta (or, given alpha,
+        estimate_beta_ridge) approximates, in one pass over x and y,
+        which can be any iterables """
+    if method == "qr":
+        solver_class = StreamingQR
+    elif method == "cholesky":
+        solver_class = NormalEquations
+    else:
+        raise ValueError("unknown method: " + method)
+
+    solver = None
+    for x_i, y_i in izip(x, y):
+        if solver is None:
+            solver = solver_class(len(x_i))
+        solver.update(x_i, y_i)
+    if solver is None:
+        raise ValueError("no data")
+    return solver.solve(alpha)
+
+
 def multiple_r_squared(x, y, beta):
     sum_of_squared_errors = sum(error(x_i, y_i, beta) ** 2 for x_i, y_i in zip(x, y))
     return 1.0 - sum_of_squared_errors / total_sum_of_squares(y)
 
 
-def bootstrap_sample(data):
+def bootstrap_sample(data, rng=random):
     """ randomly samples len(data) elements with replacement """
-    return [random.choice(data) for _ in data]
+    return choices(data, len(data), rng=rng)
 
 
 def bootstrap_statistic(data, stats_fn, num_samples):
@@ -51,6 +220,95 @@ def bootstrap_statistic(data, stats_fn, num_samples):
     return [stats_fn(bootstrap_sample(data)) for _ in range(num_samples)]
 
 
+class IndexView:
+    """ the rows of data at the given indexes, looked up on demand, so a
+        bootstrap sample doesn't have to copy the rows themselves """
+
+    def __init__(self, data, indexes):
+        self.data = data
+        self.indexes = indexes
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return IndexView(self.data, self.indexes[i])
+        return self.data[self.indexes[i]]
+
+    def __iter__(self):
+        data = self.data
+        return (data[i] for i in self.indexes)
+
+
+def bootstrap_replicates(data, stats_fn, samplers):
+    """ evaluates stats_fn on one bootstrap sample of data per sampler, each
+        sample being a whole batch of indexes drawn at once """
+    n = len(data)
+    return [stats_fn(IndexView(data, sampler.integers(n, 0, n)))
+            for sampler in samplers]
+
+
+# the data each pool worker bootstraps from, sent once when it starts
+# rather than with every batch of replicates
+_worker_data = None
+
+
+def _set_worker_data(data):
+    global _worker_data
+    _worker_data = data
+
+
+def _bootstrap_worker(batch):
+    stats_fn, samplers = batch
+    return bootstrap_replicates(_worker_data, stats_fn, samplers)
+
+
+def bootstrap(data, stats_fn, num_samples, seed=None, processes=1,
+              confidence=0.95):
+    """ evaluates stats_fn on num_samples bootstrap samples of data, and
+        returns the statistics with their standard error and a percentile
+        confidence interval (each per component if stats_fn returns a list) """
+    """ every replicate gets its own Sampler spawned from seed, so the
+        results are the same however many processes share the work; with
+        processes > 1, stats_fn must be a module-level function so that it
+        can be sent to the workers """
+    samplers = Sampler(seed).spawn(num_samples)
+
+    if processes > 1:
+        batch_size = int(math.ceil(num_samples / processes))
+        batches = [(stats_fn, samplers[i:i + batch_size])
+                   for i in range(0, num_samples, batch_size)]
+        pool = multiprocessing.Pool(processes, _set_worker_data, (data,))
+        try:
+            statistics = [statistic
+                          for batch in pool.map(_bootstrap_worker, batches)
+                          for statistic in batch]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        statistics = bootstrap_replicates(data, stats_fn, samplers)
+
+    tail = (1 - confidence) / 2
+    def summarize(values):
+        return { "standard_error": standard_deviation(values),
+                 "confidence_interval": tuple(quantiles(values, [tail, 1 - tail])) }
+
+    if isinstance(statistics[0], (list, tuple)):
+        summaries = [summarize([statistic[j] for statistic in statistics])
+                     for j in range(len(statistics[0]))]
+        return { "statistics": statistics,
+                 "standard_errors": [s["standard_error"] for s in summaries],
+                 "confidence_intervals": [s["confidence_interval"]
+                                          for s in summaries] }
+    else:
+        summary = summarize(statistics)
+        return { "statistics": statistics,
+                 "standard_error": summary["standard_error"],
+                 "confidence_interval": summary["confidence_interval"] }
+
+
 def estimate_sample_beta(sample):
     x_sample, y_sample = zip(*sample)
     return estimate_beta(x_sample, y_sample)
@@ -113,6 +371,44 @@ if __name__=="__main__":
     print "beta: ", beta
     print "r-squared: ", multiple_r_squared(x, daily_minutes_good, beta)
     print
+    random.seed(0)
+    print "mini-batch beta: ", minimize_mini_batch(
+        squared_error, squared_error_gradient, zip(x, daily_minutes_good),
+        [random.random() for _ in x[0]], 0.01, batch_size=10,
+        batch_gradient_fn=squared_error_batch_gradient)
+    print "exact least squares (QR, Cholesky): "
+    print least_squares_beta(x, daily_minutes_good)
+    print least_squares_beta(x, daily_minutes_good, method="cholesky")
+    print
+    print "full-batch L-BFGS ridge (alpha = 0.1) beta and exact ridge beta: "
+    ridge_objective = lambda beta: sum(squared_error_ridge(x_i, y_i, beta, 0.1)
+                                       for x_i, y_i in zip(x, daily_minutes_good))
+    ridge_gradient = lambda beta: reduce(vector_add,
+                                         [squared_error_ridge_gradient(x_i, y_i, beta, 0.1)
+                                          for x_i, y_i in zip(x, daily_minutes_good)])
+    print minimize_lbfgs(ridge_objective, ridge_gradient, [1, 1, 1, 1])
+    print least_squares_beta(x, daily_minutes_good, alpha=0.1)
+    print
+    print "checkpointed Adam run, early-stopped on every fourth point:"
+    import os, tempfile
+    checkpoint_path = os.path.join(tempfile.mkdtemp(), "run.pickle")
+    x_train = [x_i for i, x_i in enumerate(x) if i % 4]
+    y_train = [y_i for i, y_i in enumerate(daily_minutes_good) if i % 4]
+    def validation_error(beta):
+        return sum(squared_error(x_i, y_i, beta)
+                   for x_i, y_i in zip(x[::4], daily_minutes_good[::4]))
+    def training_run(max_epochs=None):
+        return TrainingRun(squared_error, squared_error_gradient, x_train, y_train,
+                           [1, 1, 1, 1], optimizer=Adam(0.3), batch_size=10,
+                           patience=10, max_epochs=max_epochs,
+                           validation_fn=validation_error,
+                           checkpoint_path=checkpoint_path, rng=Sampler(0))
+    training_run(max_epochs=20).run()         # stopped after 20 epochs...
+    run = training_run()                      # ...and picked up again
+    print "resumed at epoch", run.epoch
+    print "beta: ", run.run()
+    print "stopped after epoch", run.epoch, run.metrics[-1]
+    print
     print "digression: the bootstrap"
     print
     # 101 points all very close to 100
@@ -127,6 +423,11 @@ if __name__=="__main__":
     print "bootstrap_statistic(far_from_100, median, 100):"
     print bootstrap_statistic(far_from_100, median, 100)
     print
+    print "bootstrap(far_from_100, median, 1000, seed=0, processes=2):"
+    result = bootstrap(far_from_100, median, 1000, seed=0, processes=2)
+    print "standard error: ", result["standard_error"]
+    print "95% confidence interval: ", result["confidence_interval"]
+    print
     random.seed(0)
     bootstrap_betas = bootstrap_statistic(zip(x, daily_minutes_good), estimate_sample_beta, 100)
     bootstrap_standard_errors = [standard_deviation([beta[i] for beta in bootstrap_betas]) for i in range(4)]
@@ -147,3 +448,24 @@ if __name__=="__main__":
         print "dot(beta[1:], beta[1:]): ", dot(beta[1:], beta[1:])
         print "r-squared: ", multiple_r_squared(x, daily_minutes_good, beta)
         print
+
+    print "epochs to get within 1% of the exact ridge (alpha = 0.1) objective:"
+
+    optimizers = {
+        "sgd": lambda: GradientStep(0.003),
+        "momentum": lambda: Momentum(0.001),
+        "nesterov": lambda: Nesterov(0.001),
+        "adagrad": lambda: AdaGrad(3),
+        "rmsprop": lambda: RMSProp(0.3),
+        "adam": lambda: Adam(0.3),
+        "adam, warmup + cosine": lambda: Adam(0.3, schedule=warmup_schedule(
+            20, then=cosine_schedule(2000, 0.1))) }
+
+    ridge_fn = partial(squared_error_ridge, alpha=0.1)
+    ridge_gradient_fn = partial(squared_error_ridge_gradient, alpha=0.1)
+    beta_exact = least_squares_beta(x, daily_minutes_good, alpha=0.1)
+    print benchmark_optimizers(ridge_fn, ridge_gradient_fn, x, daily_minutes_good,
+                               [1, 1, 1, 1],
+                               sum(ridge_fn(x_i, y_i, beta_exact)
+                                   for x_i, y_i in zip(x, daily_minutes_good)),
+                               optimizers, batch_size=10)
@@ -111,8 +111,8 @@ def generate_sentence(grammar):
 ##
 
 
-def roll_a_die():
-    return random.choice([1,2,3,4,5,6])
+def roll_a_die(rng=random):
+    return rng.choice([1,2,3,4,5,6])
 
 
 def direct_sample():
@@ -158,9 +158,9 @@ def compare_distributions(num_samples=1000):
 ##
 
 
-def sample_from(weights):
+def sample_from(weights, rng=random):
     total = sum(weights)
-    rnd = total * random.random()     # uniform betwen 0 and total
+    rnd = total * rng.random()        # uniform betwen 0 and total
     for i, w in enumerate(weights):
         rnd -= w                      # return the smalles i such that
         if rnd <= 0: return i         # sum(weights[:(i+1)]) >= rnd
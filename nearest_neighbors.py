@@ -2,6 +2,7 @@ from __future__ import division
 from collections import Counter
 from linear_algebra import distance
 from statistics import mean
+from sampling import uniforms
 import math, random
 import matplotlib.pyplot as plt
 
@@ -113,8 +114,8 @@ def classify_and_plot_grid(k=1):
 ### The Curse Of Dimensionality ###
 
 
-def random_point(dim):
-    return [random.random() for _ in range(dim)]
+def random_point(dim, rng=random):
+    return uniforms(dim, rng=rng)
 
 
 def random_distances(dim, num_pairs):
@@ -0,0 +1,250 @@
+from __future__ import division
+from probability import Normal
+import random, bisect, hashlib, heapq, os
+
+
+# every function here takes rng, which is anything with a random() method:
+# the random module itself (the default, so existing random.seed calls keep
+# working) or a Sampler; draws come back as lists, n at a time, with the
+# per-draw work reduced to a local lookup and one call to rng.random
+
+
+def uniforms(n, low=0, high=1, rng=random):
+    """ n uniform draws from [low, high) """
+    uniform, width = rng.random, high - low
+    return [low + width * uniform() for _ in range(n)]
+
+
+def normals(n, mu=0, sigma=1, rng=random):
+    """ n draws from a normal distribution """
+    return Normal(mu, sigma).sample(n, rng)
+
+
+def integers(n, low, high, rng=random):
+    """ n draws from low, low + 1, ..., high - 1 """
+    uniform, width = rng.random, high - low
+    return [low + int(width * uniform()) for _ in range(n)]
+
+
+def choices(population, n, weights=None, replace=True, rng=random):
+    """ n elements of population, with or without replacement, each
+        element chosen in proportion to its weight (or equally likely) """
+    if not replace:
+        if weights is None:
+            return rng.sample(population, n)
+        return weighted_sample_without_replacement(population, n, weights, rng)
+
+    uniform, size = rng.random, len(population)
+    if weights is None:
+        return [population[int(size * uniform())] for _ in range(n)]
+
+    cumulative_weights = []
+    total = 0
+    for weight in weights:
+        total += weight
+        cumulative_weights.append(total)
+    return [population[bisect.bisect_right(cumulative_weights, total * uniform())]
+            for _ in range(n)]
+
+
+def weighted_sample_without_replacement(population, n, weights, rng=random):
+    """ Efraimidis-Spirakis: give each element the key u ** (1 / weight) for a
+        uniform u, and keep the n elements with the largest keys """
+    uniform = rng.random
+    keyed = ((uniform() ** (1 / weight), i)
+             for i, weight in enumerate(weights) if weight > 0)
+    return [population[i] for _, i in heapq.nlargest(n, keyed)]
+
+
+##
+## Weighted sampling of indexes
+##
+
+
+# both samplers draw index i with probability weights[i] / sum(weights),
+# like natural_language_processing.sample_from, which rescans the weights
+# on every draw
+
+
+class AliasSampler:
+    """ Walker's alias method (Vose's version): O(K) setup for K weights,
+        then every draw costs one uniform and one comparison, whatever K is;
+        for weights that don't change between draws """
+
+    def __init__(self, weights):
+        k = len(weights)
+        total = sum(weights)
+        scaled = [weight * k / total for weight in weights]   # mean 1
+
+        self.k = k
+        self.probability = [1.0] * k   # chance of keeping column i
+        self.alias = range(k)          # what column i turns into otherwise
+
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            # top up small column s with the excess of large column l
+            s, l = small.pop(), large.pop()
+            self.probability[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+        # whatever is left is 1 up to rounding error, so keeps its column
+
+    def draw(self, rng=random):
+        u = self.k * rng.random()
+        i = int(u)
+        return i if u - i < self.probability[i] else self.alias[i]
+
+    def draws(self, n, rng=random):
+        uniform, k = rng.random, self.k
+        probability, alias = self.probability, self.alias
+        indexes = []
+        for _ in range(n):
+            u = k * uniform()
+            i = int(u)
+            indexes.append(i if u - i < probability[i] else alias[i])
+        return indexes
+
+
+class FenwickSampler:
+    """ keeps the weights in a Fenwick (binary indexed) tree of partial sums,
+        so changing one weight and drawing both cost O(log K); for weights
+        that change a little between draws """
+
+    def __init__(self, weights):
+        self.k = len(weights)
+        self.weights = [0] * self.k
+        self.tree = [0] * (self.k + 1)   # 1-based, tree[i] sums a block ending at i
+        self.top_bit = 1
+        while self.top_bit * 2 <= self.k:
+            self.top_bit *= 2
+        for i, weight in enumerate(weights):
+            self.update(i, weight)
+
+    def update(self, i, weight):
+        """ sets weights[i] to weight """
+        delta = weight - self.weights[i]
+        self.weights[i] = weight
+        position = i + 1
+        while position <= self.k:
+            self.tree[position] += delta
+            position += position & -position
+
+    def total(self):
+        total, position = 0, self.k
+        while position > 0:
+            total += self.tree[position]
+            position -= position & -position
+        return total
+
+    def find(self, target):
+        """ the smallest index whose running total of weights exceeds target,
+            by walking down the tree one bit at a time """
+        position, step = 0, self.top_bit
+        while step > 0:
+            if position + step <= self.k and self.tree[position + step] <= target:
+                position += step
+                target -= self.tree[position]
+            step //= 2
+        return min(position, self.k - 1)
+
+    def draw(self, rng=random):
+        return self.find(self.total() * rng.random())
+
+    def draws(self, n, rng=random):
+        total, uniform = self.total(), rng.random
+        return [self.find(total * uniform()) for _ in range(n)]
+
+
+def benchmark_weighted_sampling(ks=(4, 10, 100, 1000), num_draws=100000):
+    """ microseconds per draw for the linear scan in sample_from, the alias
+        method and the Fenwick tree, plus microseconds per Fenwick update """
+    import time
+
+    def linear_scan(weights, rng=random):
+        total = sum(weights)
+        rnd = total * rng.random()
+        for i, w in enumerate(weights):
+            rnd -= w
+            if rnd <= 0: return i
+
+    def microseconds_per(n, fn):
+        start = time.time()
+        fn()
+        return 1e6 * (time.time() - start) / n
+
+    results = {}
+    for k in ks:
+        weights = uniforms(k)
+        alias, fenwick = AliasSampler(weights), FenwickSampler(weights)
+        new_weights = uniforms(num_draws)
+        results[k] = {
+            "linear_scan": microseconds_per(num_draws, lambda: [
+                linear_scan(weights) for _ in range(num_draws)]),
+            "alias": microseconds_per(num_draws, lambda: alias.draws(num_draws)),
+            "fenwick": microseconds_per(num_draws, lambda: fenwick.draws(num_draws)),
+            "fenwick_update": microseconds_per(num_draws, lambda: [
+                fenwick.update(i % k, w) for i, w in enumerate(new_weights)]) }
+    return results
+
+
+class Sampler(random.Random):
+    """ a seedable random number generator (everything random.Random does),
+        with batched draws and independent child streams for workers """
+
+    def __init__(self, seed=None):
+        if seed is None:
+            seed = int(os.urandom(16).encode("hex"), 16)
+        self.root_seed = seed
+        self.num_spawned = 0
+        random.Random.__init__(self, seed)
+
+    def spawn(self, n):
+        """ n child Samplers, each seeded from a hash of this Sampler's seed
+            and the child's number, so the streams don't overlap, and the
+            same parent seed always gives the same children in the same
+            order whatever draws the parent has made """
+        children = []
+        for _ in range(n):
+            child_seed = int(hashlib.sha256(repr((self.root_seed,
+                                                  self.num_spawned))
+                                            ).hexdigest(), 16)
+            children.append(Sampler(child_seed))
+            self.num_spawned += 1
+        return children
+
+    def uniforms(self, n, low=0, high=1):
+        return uniforms(n, low, high, self)
+
+    def normals(self, n, mu=0, sigma=1):
+        return normals(n, mu, sigma, self)
+
+    def integers(self, n, low, high):
+        return integers(n, low, high, self)
+
+    def choices(self, population, n, weights=None, replace=True):
+        return choices(population, n, weights, replace, self)
+
+
+if __name__ == "__main__":
+    sampler = Sampler(0)
+    print "uniforms: ", sampler.uniforms(3)
+    print "normals: ", sampler.normals(3)
+    print "integers: ", sampler.integers(10, 1, 7)
+    print "weighted choices: ", sampler.choices("abc", 10, weights=[1, 2, 7])
+    print "weighted, no replacement: ", sampler.choices("abcdef", 3,
+                                                        weights=[1, 1, 1, 5, 5, 5],
+                                                        replace=False)
+    print
+    print "first draw from each of 3 spawned streams, twice: "
+    print [child.random() for child in Sampler(0).spawn(3)]
+    print [child.random() for child in Sampler(0).spawn(3)]
+    print
+    print "alias and Fenwick draws for weights [1, 2, 7]: "
+    print AliasSampler([1, 2, 7]).draws(10, sampler)
+    print FenwickSampler([1, 2, 7]).draws(10, sampler)
+    print
+    print "microseconds per draw by number of weights: "
+    for k, timings in sorted(benchmark_weighted_sampling().items()):
+        print k, timings
@@ -0,0 +1,207 @@
+from __future__ import division
+from collections import Counter
+import math, hashlib, struct, heapq
+
+
+def hash64(item, seed=0):
+    """ a 64-bit hash of item that is the same in every process,
+        so sketches built by different mappers can be merged """
+    digest = hashlib.md5(repr((seed, item))).digest()
+    return struct.unpack("<Q", digest[:8])[0]
+
+
+##
+## HyperLogLog
+##
+
+
+class HyperLogLog:
+    """ estimates the number of distinct items added, using 2**precision
+        one-byte registers; the standard error is about 1.04 / sqrt(2**precision),
+        so 1.6% for the default precision of 12 (4KB) """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.num_registers = 2 ** precision
+        self.registers = bytearray(self.num_registers)
+
+    def add(self, item):
+        x = hash64(item)
+        # the first precision bits choose a register
+        index = x >> (64 - self.precision)
+        # the rest are scanned for the position of their leftmost 1-bit
+        remaining_bits = 64 - self.precision
+        rest = x & ((1 << remaining_bits) - 1)
+        rank = remaining_bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """ folds other into this sketch, as if its items had been added here """
+        if other.precision != self.precision:
+            raise ValueError("can only merge sketches of equal precision")
+        for i, rank in enumerate(other.registers):
+            if rank > self.registers[i]:
+                self.registers[i] = rank
+        return self
+
+    def count(self):
+        m = self.num_registers
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -rank for rank in self.registers)
+
+        empty_registers = self.registers.count(b"\x00")
+        if estimate <= 2.5 * m and empty_registers > 0:
+            # for small counts, linear counting is more accurate
+            return int(round(m * math.log(m / empty_registers)))
+        return int(round(estimate))
+
+
+##
+## Count-Min Sketch
+##
+
+
+class CountMinSketch:
+    """ estimates how often each item was added in depth * width counters;
+        estimates never undercount, and overcount by at most
+        e / width * (total count) with probability 1 - exp(-depth) """
+    """ also keeps the top_k items with the highest estimates, so that
+        heavy hitters can be read back out """
+
+    def __init__(self, width=2000, depth=5, top_k=10):
+        self.width = width
+        self.depth = depth
+        self.top_k = top_k
+        self.table = [[0] * width for _ in range(depth)]
+        self.candidates = {}     # item -> estimated count, at most top_k of them
+
+    def cells(self, item):
+        """ the column for item in each row, from two independent hashes """
+        h1, h2 = hash64(item, 1), hash64(item, 2)
+        return [(h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, item, count=1):
+        estimate = None
+        for row, column in enumerate(self.cells(item)):
+            self.table[row][column] += count
+            if estimate is None or self.table[row][column] < estimate:
+                estimate = self.table[row][column]
+        self.consider(item, estimate)
+
+    def estimate(self, item):
+        return min(self.table[row][column]
+                   for row, column in enumerate(self.cells(item)))
+
+    def consider(self, item, estimate):
+        """ keeps item as a heavy-hitter candidate if it is in the top_k """
+        self.candidates[item] = estimate
+        if len(self.candidates) > self.top_k:
+            smallest = min(self.candidates, key=self.candidates.get)
+            del self.candidates[smallest]
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("can only merge sketches of equal dimensions")
+        for row, other_row in zip(self.table, other.table):
+            for column, count in enumerate(other_row):
+                row[column] += count
+        # counts went up everywhere, so re-estimate every candidate
+        for item in set(self.candidates) | set(other.candidates):
+            self.consider(item, self.estimate(item))
+        return self
+
+    def most_common(self, n=None):
+        """ the heavy hitters as (item, estimated count), largest first """
+        return Counter(self.candidates).most_common(n)
+
+
+##
+## Space-Saving
+##
+
+
+class SpaceSaving:
+    """ tracks the (approximately) k most frequent items in k counters; any
+        item occurring more than total / k times is guaranteed to be kept,
+        and each count is too high by at most the smallest count kept """
+
+    def __init__(self, k=10):
+        self.k = k
+        self.counts = {}
+
+    def add(self, item, count=1):
+        if item in self.counts:
+            self.counts[item] += count
+        elif len(self.counts) < self.k:
+            self.counts[item] = count
+        else:
+            # replace the smallest counter, inheriting its count as error
+            smallest = min(self.counts, key=self.counts.get)
+            self.counts[item] = self.counts.pop(smallest) + count
+
+    def floor(self):
+        """ the count an item not being tracked could have at most """
+        if len(self.counts) < self.k:
+            return 0
+        return min(self.counts.itervalues())
+
+    def merge(self, other):
+        """ combines two summaries: an item missing from one side is
+            assumed to have that side's floor, then the top k are kept """
+        self_floor, other_floor = self.floor(), other.floor()
+        merged = dict((item, self.counts.get(item, self_floor) +
+                             other.counts.get(item, other_floor))
+                      for item in set(self.counts) | set(other.counts))
+        self.counts = dict(Counter(merged).most_common(self.k))
+        return self
+
+    def most_common(self, n=None):
+        """ the tracked items as (item, estimated count), largest first """
+        return Counter(self.counts).most_common(n)
+
+
+##
+## Misra-Gries
+##
+
+
+class MisraGries:
+    """ approximate counts of the most frequent items in k - 1 counters:
+        every item occurring more than total / k times is kept, and each
+        count is too low by at most total / k """
+
+    def __init__(self, k=100):
+        self.k = k
+        self.counts = {}
+
+    def add(self, item, count=1):
+        if item in self.counts:
+            self.counts[item] += count
+        elif len(self.counts) < self.k - 1:
+            self.counts[item] = count
+        else:
+            self.counts[item] = count
+            self.decrement(min(self.counts.itervalues()))
+
+    def decrement(self, amount):
+        """ subtracts amount from every counter, dropping the ones that
+            reach zero (the decrement is shared by k counters, which is
+            where the total / k error bound comes from) """
+        self.counts = dict((item, count - amount)
+                           for item, count in self.counts.iteritems()
+                           if count > amount)
+
+    def merge(self, other):
+        """ adds the counters, then takes the k-th largest count off them
+            all, which keeps the error bound of the combined stream """
+        for item, count in other.counts.iteritems():
+            self.counts[item] = self.counts.get(item, 0) + count
+        if len(self.counts) >= self.k:
+            kth_largest = heapq.nlargest(self.k, self.counts.itervalues())[-1]
+            self.decrement(kth_largest)
+        return self
+
+    def most_common(self, n=None):
+        """ the tracked items as (item, estimated count), largest first """
+        return Counter(self.counts).most_common(n)
@@ -1,7 +1,9 @@
 from __future__ import division
 from collections import Counter
-from linear_algebra import dot, sum_of_squares
-import math
+from linear_algebra import dot, sum_of_squares, shape, get_column, make_matrix
+from sketches import CountMinSketch, MisraGries
+from array import array
+import math, random, heapq
 
 
 def mean(x):
@@ -17,22 +19,89 @@ def de_mean(x):
 def median(v):
     """ finds the 'middle-most' value of v """
     n = len(v)
-    sorted_v = sorted(v)
     midpoint = n // 2
     if n % 2 == 1:
         # if odd, return the middle value
-        return sorted_v[midpoint]
+        return select(v, midpoint)
     else:
         # if even, return the average of the middle values
         lo = midpoint - 1
         hi = midpoint
-        return (sorted_v[lo] + sorted_v[hi]) / 2
+        lo_value, hi_value = select_many(v, [lo, hi])
+        return (lo_value + hi_value) / 2
 
 
 def quantile(x, p):
     """ returns the pth-percentile value in x """
     p_index = int(p * len(x))
-    return sorted(x)[p_index]
+    return select(x, p_index)
+
+
+def quantiles(x, ps):
+    """ returns the pth-percentile value in x for each p in ps, sharing
+        the partitioning work between them """
+    return select_many(x, [int(p * len(x)) for p in ps])
+
+
+def select(v, k):
+    """ the k-th smallest value in v (counting from 0), in O(n) time
+        instead of the O(n log n) of sorting v """
+    return select_many(v, [k])[0]
+
+
+def select_many(v, ks):
+    """ the k-th smallest value in v for each k in ks """
+    """ introselect: partition around a pivot (the median of three values)
+        and only keep going on the sides where some k is; if the partitions
+        keep coming out lopsided, switch to the median-of-medians pivot,
+        which guarantees linear time """
+    results = {}
+    lopsided_splits_allowed = 2 * int(math.log(len(v) + 1, 2))
+    select_into(v, sorted(set(ks)), 0, lopsided_splits_allowed, results)
+    return [results[k] for k in ks]
+
+
+def select_into(v, ks, offset, lopsided_splits_allowed, results):
+    """ finds the (k - offset)-th smallest value of v for each k in ks,
+        storing it in results[k] """
+    if len(v) <= 10:
+        sorted_v = sorted(v)
+        for k in ks:
+            results[k] = sorted_v[k - offset]
+        return
+
+    if lopsided_splits_allowed > 0:
+        pivot = sorted([v[0], v[len(v) // 2], v[-1]])[1]
+    else:
+        pivot = median_of_medians(v)
+
+    lows = [v_i for v_i in v if v_i < pivot]
+    highs = [v_i for v_i in v if v_i > pivot]
+    num_equal = len(v) - len(lows) - len(highs)
+    if max(len(lows), len(highs)) > 3 * len(v) // 4:
+        lopsided_splits_allowed -= 1
+
+    low_ks, high_ks = [], []
+    for k in ks:
+        if k - offset < len(lows):
+            low_ks.append(k)
+        elif k - offset < len(lows) + num_equal:
+            results[k] = pivot
+        else:
+            high_ks.append(k)
+
+    if low_ks:
+        select_into(lows, low_ks, offset, lopsided_splits_allowed, results)
+    if high_ks:
+        select_into(highs, high_ks, offset + len(lows) + num_equal,
+                    lopsided_splits_allowed, results)
+
+
+def median_of_medians(v):
+    """ a pivot guaranteed to have at least 30% of v on each side """
+    medians = [sorted(v[i:i + 5])[len(v[i:i + 5]) // 2]
+               for i in range(0, len(v), 5)]
+    return select(medians, len(medians) // 2)
 
 
 def mode(x):
@@ -65,3 +134,414 @@ def correlation(x, y):
         return covariance(x, y) / stdev_x / stdev_y
     else:
         return 0  # if there is no variation, correlation is zer0
+
+
+def correlation_matrix(data_matrix):
+    """ returns the num_columns by num_columns matrix whose (i,j)th entry is
+        the correlation between columns i and j of data_matrix """
+    """ each column is standardized once, after which every entry is just a
+        dot product (the Gram matrix of the standardized columns), instead
+        of calling correlation, which recomputes means and standard
+        deviations, for every pair """
+    num_rows, num_columns = shape(data_matrix)
+    columns = [get_column(data_matrix, j) for j in range(num_columns)]
+
+    standardized = []
+    for column in columns:
+        stdev = standard_deviation(column)
+        if stdev > 0:
+            standardized.append([d / stdev for d in de_mean(column)])
+        else:
+            standardized.append(None)    # no variation, correlation is zero
+
+    gram = {}
+    for i in range(num_columns):
+        for j in range(i, num_columns):
+            if standardized[i] is None or standardized[j] is None:
+                gram[i, j] = 0
+            else:
+                gram[i, j] = dot(standardized[i], standardized[j]) / (num_rows - 1)
+
+    return make_matrix(num_columns, num_columns,
+                       lambda i, j: gram[min(i, j), max(i, j)])
+
+
+##
+## Streaming statistics
+##
+
+
+# the functions above need the whole dataset in a list and make several
+# passes over it; these accumulators see each value once, can be fed one
+# value or one chunk at a time, and can be merged, so each shard of a
+# dataset can be summarised separately and the summaries combined
+
+
+class RunningStats:
+    """ count, mean and variance of a stream, by Welford's method: keeps the
+        running mean and the sum of squared deviations from it, which is
+        numerically stable where sum(x) and sum(x ** 2) are not """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0          # sum of squared deviations from the mean
+
+    def update(self, x_i):
+        self.n += 1
+        delta = x_i - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x_i - self.mean)
+        return self
+
+    def update_all(self, chunk):
+        """ summarises chunk on its own, then merges it in """
+        chunk_stats = RunningStats()
+        for x_i in chunk:
+            chunk_stats.update(x_i)
+        return self.merge(chunk_stats)
+
+    def merge(self, other):
+        """ combines two summaries (Chan et al.) as if one had seen both streams """
+        n = self.n + other.n
+        if n == 0:
+            return self
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta ** 2 * self.n * other.n / n
+        self.n = n
+        return self
+
+    def variance(self):
+        """ assumes at least 2 values have been seen """
+        return self.m2 / (self.n - 1)
+
+    def standard_deviation(self):
+        return math.sqrt(self.variance())
+
+
+class RunningCovariance:
+    """ covariance and correlation of a stream of (x, y) pairs, keeping
+        the running co-moment sum((x - x_bar) * (y - y_bar)) alongside a
+        RunningStats for each of x and y """
+
+    def __init__(self):
+        self.x_stats = RunningStats()
+        self.y_stats = RunningStats()
+        self.c2 = 0.0          # co-moment
+
+    def update(self, x_i, y_i):
+        # the co-moment update needs x's deviation from the old mean
+        # and y's deviation from the new one
+        dx = x_i - self.x_stats.mean
+        self.x_stats.update(x_i)
+        self.y_stats.update(y_i)
+        self.c2 += dx * (y_i - self.y_stats.mean)
+        return self
+
+    def update_all(self, xs, ys):
+        chunk_stats = RunningCovariance()
+        for x_i, y_i in zip(xs, ys):
+            chunk_stats.update(x_i, y_i)
+        return self.merge(chunk_stats)
+
+    def merge(self, other):
+        n = self.x_stats.n + other.x_stats.n
+        if n == 0:
+            return self
+        dx = other.x_stats.mean - self.x_stats.mean
+        dy = other.y_stats.mean - self.y_stats.mean
+        self.c2 += other.c2 + dx * dy * self.x_stats.n * other.x_stats.n / n
+        self.x_stats.merge(other.x_stats)
+        self.y_stats.merge(other.y_stats)
+        return self
+
+    def covariance(self):
+        return self.c2 / (self.x_stats.n - 1)
+
+    def correlation(self):
+        stdev_x = self.x_stats.standard_deviation()
+        stdev_y = self.y_stats.standard_deviation()
+        if stdev_x > 0 and stdev_y > 0:
+            return self.covariance() / stdev_x / stdev_y
+        else:
+            return 0  # if there is no variation, correlation is zero
+
+
+class RunningCorrelationMatrix:
+    """ the correlation matrix of a stream of rows, from the running mean
+        of each column and the co-moment of every pair of columns, updated
+        a row or a chunk of rows at a time """
+
+    def __init__(self, num_columns):
+        self.num_columns = num_columns
+        self.n = 0
+        self.means = [0.0] * num_columns
+        self.comoments = [[0.0] * num_columns for _ in range(num_columns)]
+
+    def update(self, row):
+        self.n += 1
+        old_deviations = [x_j - mean_j for x_j, mean_j in zip(row, self.means)]
+        self.means = [mean_j + d_j / self.n
+                      for mean_j, d_j in zip(self.means, old_deviations)]
+        new_deviations = [x_j - mean_j for x_j, mean_j in zip(row, self.means)]
+        for i, d_i in enumerate(old_deviations):
+            comoments_i = self.comoments[i]
+            for j in range(i, self.num_columns):
+                comoments_i[j] += d_i * new_deviations[j]
+        return self
+
+    def update_all(self, rows):
+        chunk = RunningCorrelationMatrix(self.num_columns)
+        for row in rows:
+            chunk.update(row)
+        return self.merge(chunk)
+
+    def merge(self, other):
+        n = self.n + other.n
+        if n == 0:
+            return self
+        deltas = [other_mean - mean
+                  for mean, other_mean in zip(self.means, other.means)]
+        weight = self.n * other.n / n
+        for i in range(self.num_columns):
+            for j in range(i, self.num_columns):
+                self.comoments[i][j] += (other.comoments[i][j] +
+                                         deltas[i] * deltas[j] * weight)
+        self.means = [mean + delta * other.n / n
+                      for mean, delta in zip(self.means, deltas)]
+        self.n = n
+        return self
+
+    def covariance_matrix(self):
+        return make_matrix(self.num_columns, self.num_columns,
+                           lambda i, j: self.comoments[min(i, j)][max(i, j)]
+                                        / (self.n - 1))
+
+    def correlation_matrix(self):
+        stdevs = [math.sqrt(self.comoments[j][j] / (self.n - 1))
+                  for j in range(self.num_columns)]
+        def entry(i, j):
+            if stdevs[i] > 0 and stdevs[j] > 0:
+                return (self.comoments[min(i, j)][max(i, j)] / (self.n - 1)
+                        / stdevs[i] / stdevs[j])
+            else:
+                return 0  # if there is no variation, correlation is zero
+        return make_matrix(self.num_columns, self.num_columns, entry)
+
+
+class QuantileSketch:
+    """ approximate quantiles of a stream in O(k log(n / k)) memory (a KLL
+        sketch): values go into a stack of compactors, and whenever a level
+        is full it is sorted and every other value is promoted to the next
+        level, where each value stands for twice as many; the rank error is
+        about 1.7 / k of n """
+
+    def __init__(self, k=200, rng=random):
+        self.k = k
+        self.rng = rng
+        self.n = 0
+        self.compactors = [[]]     # compactors[h] holds values of weight 2 ** h
+        self.size = 0
+        self.max_size = self.capacity(0)
+
+    def capacity(self, level):
+        """ lower levels get geometrically less room than the top one """
+        height = len(self.compactors)
+        return 2 * int(math.ceil(self.k * (2 / 3) ** (height - level - 1))) + 1
+
+    def grow(self):
+        self.compactors.append([])
+        self.max_size = sum(self.capacity(level)
+                            for level in range(len(self.compactors)))
+
+    def update(self, x_i):
+        self.compactors[0].append(x_i)
+        self.n += 1
+        self.size += 1
+        if self.size >= self.max_size:
+            self.compress()
+        return self
+
+    def update_all(self, chunk):
+        for x_i in chunk:
+            self.update(x_i)
+        return self
+
+    def compress(self):
+        for level in range(len(self.compactors)):
+            if len(self.compactors[level]) >= self.capacity(level):
+                if level + 1 >= len(self.compactors):
+                    self.grow()
+                self.compact(level)
+                self.size = sum(len(compactor) for compactor in self.compactors)
+                if self.size < self.max_size:
+                    break
+
+    def compact(self, level):
+        """ promotes every other value of a sorted level, starting at a
+            random one of the first two; an odd one out stays behind """
+        compactor = sorted(self.compactors[level])
+        leftover = [compactor.pop()] if len(compactor) % 2 else []
+        offset = 1 if self.rng.random() < 0.5 else 0
+        self.compactors[level + 1].extend(compactor[offset::2])
+        self.compactors[level] = leftover
+
+    def merge(self, other):
+        """ folds other into this sketch, as if its values had been added here """
+        while len(self.compactors) < len(other.compactors):
+            self.grow()
+        for level, compactor in enumerate(other.compactors):
+            self.compactors[level].extend(compactor)
+        self.n += other.n
+        self.size = sum(len(compactor) for compactor in self.compactors)
+        while self.size >= self.max_size:
+            self.compress()
+        return self
+
+    def quantiles(self, ps):
+        """ the approximate pth-percentile value for each p in ps """
+        if self.n == 0:
+            raise ValueError("an empty QuantileSketch has no quantiles")
+        weighted = sorted((x_i, 2 ** level)
+                          for level, compactor in enumerate(self.compactors)
+                          for x_i in compactor)
+        total_weight = sum(weight for _, weight in weighted)
+
+        results = []
+        for p in ps:
+            target = p * total_weight
+            running_weight = 0
+            for x_i, weight in weighted:
+                running_weight += weight
+                if running_weight > target:
+                    break
+            results.append(x_i)
+        return results
+
+    def quantile(self, p):
+        return self.quantiles([p])[0]
+
+
+##
+## Frequency statistics
+##
+
+
+# the range of the machine integers FrequencyTable's array('l') can hold
+FREQUENCY_TABLE_BITS = 8 * array('l').itemsize
+FREQUENCY_TABLE_MIN = -2 ** (FREQUENCY_TABLE_BITS - 1)
+FREQUENCY_TABLE_MAX = 2 ** (FREQUENCY_TABLE_BITS - 1) - 1
+
+
+class FrequencyTable:
+    """ exact counts of a stream of (possibly very many distinct) integers,
+        in two flat arrays, keys and counts, rather than as a dict of int
+        objects like Counter: a distinct value costs 2 machine words and a
+        byte per slot, with the table kept at most 70% full """
+    """ collisions are resolved by open addressing: a value's slot is the
+        top bits of its multiplicative hash, or the next free one after it;
+        growing briefly needs the old arrays as well as the new ones, so
+        pass capacity if the number of distinct values is known """
+
+    def __init__(self, capacity=16):
+        self.bits = max(int(math.ceil(math.log(capacity, 2))), 1)
+        self.size = 0                               # distinct values
+        self.keys = array('l', [0]) * 2 ** self.bits
+        self.counts = array('l', [0]) * 2 ** self.bits
+        self.used = bytearray(2 ** self.bits)       # 1 if the slot holds a key
+
+    def slot(self, x_i):
+        """ the slot holding x_i, or the free slot where it would go """
+        mask = len(self.keys) - 1
+        # fold to 32 bits first, so the arithmetic stays in machine ints
+        h = (x_i ^ (x_i >> 32)) & 0xFFFFFFFF
+        i = ((h * 2654435769) & 0xFFFFFFFF) >> (32 - self.bits)
+        keys, used = self.keys, self.used
+        while used[i] and keys[i] != x_i:
+            i = (i + 1) & mask
+        return i
+
+    def update(self, x_i, count=1):
+        if not isinstance(x_i, (int, long)):
+            raise TypeError("FrequencyTable counts integers, not %r "
+                            "(use a Counter)" % (x_i,))
+        if not FREQUENCY_TABLE_MIN <= x_i <= FREQUENCY_TABLE_MAX:
+            raise ValueError("FrequencyTable counts integers that fit in %d bits, "
+                             "not %r (use a Counter)" % (FREQUENCY_TABLE_BITS, x_i))
+        i = self.slot(x_i)
+        if not self.used[i]:
+            if 10 * (self.size + 1) > 7 * len(self.keys):
+                self.grow()
+                i = self.slot(x_i)
+            self.used[i] = 1
+            self.keys[i] = x_i
+            self.size += 1
+        self.counts[i] += count
+        return self
+
+    def grow(self):
+        """ doubles the table and reinserts every key """
+        keys, counts, used, size = self.keys, self.counts, self.used, self.size
+        self.__init__(2 ** (self.bits + 1))
+        for j in xrange(len(keys)):
+            if used[j]:
+                i = self.slot(keys[j])
+                self.used[i] = 1
+                self.keys[i] = keys[j]
+                self.counts[i] = counts[j]
+        self.size = size
+
+    def update_all(self, chunk):
+        for x_i in chunk:
+            self.update(x_i)
+        return self
+
+    def items(self):
+        """ generates (value, count) pairs, in no particular order """
+        keys, counts, used = self.keys, self.counts, self.used
+        for i in xrange(len(keys)):
+            if used[i]:
+                yield keys[i], counts[i]
+
+    def merge(self, other):
+        for value, count in other.items():
+            self.update(value, count)
+        return self
+
+    def count(self, x_i):
+        i = self.slot(x_i)
+        return self.counts[i] if self.used[i] else 0
+
+    def modes(self):
+        """ like mode, a list of every value with the highest count """
+        if not self.size:
+            return []
+        max_count = max(count for _, count in self.items())
+        return [value for value, count in self.items() if count == max_count]
+
+    def most_common(self, n):
+        return heapq.nlargest(n, self.items(), key=lambda item: item[1])
+
+
+def approximate_top_k(x, k, method="misra_gries"):
+    """ the (approximately) k most frequent values in the stream x, with
+        their (approximate) counts, in fixed memory """
+    if method == "misra_gries":
+        summary = MisraGries(k=10 * k)
+    elif method == "count_min":
+        summary = CountMinSketch(top_k=k)
+    else:
+        raise ValueError("unknown method: " + method)
+    for x_i in x:
+        summary.add(x_i)
+    return summary.most_common(k)
+
+
+def approximate_mode(x, method="misra_gries"):
+    """ the (approximately) most frequent value in the stream x """
+    top = approximate_top_k(x, 1, method)
+    if not top:
+        raise ValueError("approximate_mode of an empty stream")
+    [(value, count)] = top
+    return value